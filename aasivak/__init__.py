@@ -0,0 +1,16 @@
+# Hi-Kumo bridge for Home Assistant.
+#
+# The bridge lives in aasivak.bridge and is only imported when one of its names is first used, so that importing the
+# package or starting the command line does not pay for requests, paho-mqtt and the rest.
+
+import importlib
+
+__version__ = "0.2.0"
+
+
+def __getattr__(name):
+    bridge = importlib.import_module("aasivak.bridge")
+    try:
+        return getattr(bridge, name)
+    except AttributeError:
+        raise AttributeError("module 'aasivak' has no attribute '%s'" % name) from None
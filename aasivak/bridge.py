@@ -0,0 +1,3179 @@
+import bisect
+import gzip
+import hashlib
+import heapq
+import json
+import queue
+import random
+import ssl
+import threading
+import time
+import logging
+import os
+import sys
+from urllib.parse import quote, urlparse
+
+import paho.mqtt.client as mqtt
+import requests
+
+
+################
+
+# TODO: refactor the code to make it clearer what's the Hi-Kumo adapter and what is the HA adapter
+# TODO: figure out how to set and unset the "GREEN" state
+# TODO: figure out how to set and unset the "leave_home" state
+# TODO: from reading the protocol variables and the webapp javascript (https://pastebin.com/HZKsEPjU), it seems there is
+#  a way to enable a "local mode" but I have not found how. I suspect (and secretly hope) that this would open a port on
+#  the local network that allows direct commands without the need for bouncing through the Hi-Kumo/Overkiz cloud.
+#  Gateways that do expose the Overkiz local API (developer mode) can be set in local_gateways.
+
+################
+
+class Device:
+    raw_state_attributes = {
+        "hlrrwifi:MainOperationState": "power_state",
+        "hlrrwifi:LeaveHomeState": "leave_home",
+        "hlrrwifi:ModeChangeState": "mode",
+        "hlrrwifi:SwingState": "swing_mode",
+        "hlrrwifi:FanSpeedState": "fan_mode",
+        "hlrrwifi:RoomTemperatureState": "temperature",
+        "core:TargetTemperatureState": "target_temperature",
+        "hlrrwifi:OutdoorTemperatureState": "outdoor_temperature",
+        "core:ProductModelNameState": "product_name"
+    }
+
+    raw_definition_attributes = {
+        "hlrrwifi:MainOperationState": "power_states",
+        "hlrrwifi:ModeChangeState": "modes",
+        "hlrrwifi:FanSpeedState": "fan_modes",
+        "hlrrwifi:SwingState": "swing_modes",
+    }
+
+    int_attributes = [
+        "temperature",
+        "target_temperature",
+        "outdoor_temperature"
+    ]
+
+    # Key = Hi-Kumo mode, Value = HA mode
+    modes_map = {
+        "auto": "auto",
+        "cooling": "cool",
+        #"autoCooling": "cool",
+        "dehumidify": "dry",
+        "fan": "fan_only",
+        "heating": "heat",
+        "off": "off"
+    }
+
+    # Key = HA mode, Value = Hi-Kumo mode
+    rev_modes_map = {
+        "auto": "auto",
+        "cool": "cooling",
+        "dry": "dehumidify",
+        "fan_only": "fan",
+        "heat": "heating",
+        "off": "off"
+    }
+
+    # Command topic suffix, attribute and payload parser of each command
+    commands = [
+        ("mode", "mode", str),
+        ("target_temp", "target_temperature", lambda payload: int(float(payload))),
+        ("fan_mode", "fan_mode", str),
+        ("swing_mode", "swing_mode", str)
+    ]
+
+    # Attributes changed by the commands, restored when an execution fails
+    commanded_attributes = ["power_state", "mode", "target_temperature", "fan_mode", "swing_mode"]
+
+    __slots__ = (
+        "house", "id", "name", "command_url",
+        "power_state", "leave_home", "leave_home_state", "mode", "swing_mode", "fan_mode", "temperature",
+        "target_temperature", "outdoor_temperature", "product_name", "available",
+        "power_states", "modes", "fan_modes", "swing_modes",
+        "climate_discovery_topic", "outdoor_temp_sensor_discovery_topic",
+        "temperature_state_topic", "mode_state_topic", "target_temperature_state_topic", "fan_mode_state_topic",
+        "swing_mode_state_topic", "availability_topic", "outdoor_temperature_state_topic", "attributes_topic",
+        "command_topics", "stale", "discovery_hash", "state_dirty", "command_received", "last_update", "published",
+        "last_full_publish", "raw_definitions", "raw_states", "pending_execution", "rollback_state", "refresh_delayer",
+        "next_refresh", "refresh_temperature", "command_sent"
+    )
+
+    def __init__(self, house, device_id, name, command_url):
+        self.house = house
+        self.id = device_id
+        self.name = name
+        self.command_url = command_url
+        self.power_state = ""
+        self.leave_home = ""
+        self.leave_home_state = ""
+        self.mode = ""
+        self.swing_mode = ""
+        self.fan_mode = ""
+        self.temperature = 0
+        self.target_temperature = 0
+        self.outdoor_temperature = 0
+        self.product_name = ""
+        self.available = ""
+        self.power_states = []
+        self.modes = []
+        self.fan_modes = []
+        self.swing_modes = []
+        self.climate_discovery_topic = sys.intern(
+            house.config.mqtt_discovery_prefix + "/climate/" + self.id + "/config")
+        self.outdoor_temp_sensor_discovery_topic = sys.intern(
+            house.config.mqtt_discovery_prefix + "/sensor/" + self.id + "_outdoor_temp/config")
+        self.update_mqtt_config()
+        self.discovery_hash = None  # hash of the last published discovery messages
+        self.state_dirty = False  # state is considered dirty when changed locally and not yet sent to HiKumo
+        self.command_received = 0  # when the first command since the last time the state was sent was received
+        self.command_sent = 0  # when the state was last sent to Hi-Kumo
+        self.last_update = 0  # when the state was last received from Hi-Kumo
+        self.stale = False  # whether the state comes from the snapshot, until received from Hi-Kumo
+        self.published = {}  # last payload published on each state topic
+        self.last_full_publish = 0
+        self.raw_definitions = None  # definitions almost never change: they are only processed when they do
+        self.raw_states = {}  # last raw value of each state, to skip the ones that did not change
+        self.pending_execution = None  # id of the Hi-Kumo execution of the last commands sent, until it completes
+        self.rollback_state = None  # commanded attributes as last confirmed by Hi-Kumo, until the commands succeed
+        # Refresh cadence of this device alone, in the "devices" refresh mode
+        self.refresh_delayer = Delayer(house.config.refresh_delays, house.config.refresh_delay_randomness)
+        self.next_refresh = 0
+        self.refresh_temperature = None  # temperature when the last refresh was scheduled
+
+    def update_definitions(self, raw_definitions):
+        if raw_definitions == self.raw_definitions:
+            return
+        self.raw_definitions = raw_definitions
+        for definition in raw_definitions:
+            definition_name = definition["qualifiedName"]
+            if definition_name in Device.raw_definition_attributes:
+                setattr(self, Device.raw_definition_attributes[definition_name], list(definition["values"]))
+        self.modes.remove("autoCooling")
+        self.modes.append("off")
+
+    snapshot_attributes = [
+        "power_state", "leave_home", "mode", "swing_mode", "fan_mode", "temperature", "target_temperature",
+        "outdoor_temperature", "product_name", "available", "power_states", "modes", "fan_modes", "swing_modes",
+        "last_update"
+    ]
+
+    def to_snapshot(self):
+        raw = {"id": self.id, "name": self.name, "url": self.command_url}
+        for attr in Device.snapshot_attributes:
+            raw[attr] = getattr(self, attr)
+        return raw
+
+    @staticmethod
+    def from_snapshot(house, raw):
+        device = Device(house, raw["id"], raw["name"], raw["url"])
+        for attr in Device.snapshot_attributes:
+            if attr in raw:
+                setattr(device, attr, raw[attr])
+        device.stale = True
+        return device
+
+    def invalidate_cache(self):
+        self.raw_definitions = None
+        self.raw_states = {}
+
+    # Temperatures in HiKumo seem to be encoded as signed bytes and transported as integers in the json API
+    def sanitize_temp(self, string):
+        temp = int(float(string))
+        if temp > 127:
+            return temp - 256
+        else:
+            return temp
+
+    def update_states(self, raw_states, availability):
+        if self.state_dirty or self.pending_execution is not None:
+            # Do not update the current state of the device while it is dirty or while the last command is running:
+            # Hi-Kumo may still return the state from before the command
+            return
+
+        self.update_availability(availability)
+        self.apply_states(raw_states)
+        self.last_update = time.time()
+        self.stale = False
+
+    # Applies a partial list of states, as received in a DeviceStateChangedEvent
+    def update_states_delta(self, raw_states):
+        if self.state_dirty:
+            return
+        self.apply_states(raw_states)
+        self.last_update = time.time()
+        self.stale = False
+
+    def update_availability(self, availability):
+        if availability:
+            self.available = "online"
+        else:
+            self.available = "offline"
+
+    def apply_states(self, raw_states):
+        for state in raw_states:
+            state_name = state["name"]
+            if self.raw_states.get(state_name, None) == state["value"]:
+                continue
+            if state_name in Device.raw_state_attributes:
+                self.raw_states[state_name] = state["value"]
+                attr_name = Device.raw_state_attributes[state_name]
+                if attr_name in self.int_attributes:
+                    setattr(self, attr_name, self.sanitize_temp(state["value"]))
+                elif attr_name == "mode" and state["value"] == "autoCooling":
+                    setattr(self, attr_name, "cooling")
+                else:
+                    setattr(self, attr_name, state["value"])
+
+    def update_mqtt_config(self):
+        state_prefix = self.house.config.mqtt_state_prefix + "/" + self.id + "/"
+        command_prefix = self.house.config.mqtt_command_prefix + "/" + self.id + "/"
+        self.temperature_state_topic = sys.intern(state_prefix + "temp")
+        self.mode_state_topic = sys.intern(state_prefix + "mode")
+        self.target_temperature_state_topic = sys.intern(state_prefix + "target_temp")
+        self.fan_mode_state_topic = sys.intern(state_prefix + "fan_mode")
+        self.swing_mode_state_topic = sys.intern(state_prefix + "swing_mode")
+        self.availability_topic = sys.intern(state_prefix + "availability")
+        self.outdoor_temperature_state_topic = sys.intern(state_prefix + "outdoor_temp")
+        self.attributes_topic = sys.intern(state_prefix + "attributes")
+        # Command topic -> (attribute, payload parser)
+        self.command_topics = {sys.intern(command_prefix + suffix): (attr, parser)
+                               for suffix, attr, parser in Device.commands}
+
+    # The discovery configs are only needed when registering, so they are built on demand rather than kept around
+    def climate_mqtt_config(self):
+        command_topics = {attr: topic for topic, (attr, parser) in self.command_topics.items()}
+        return {
+            "name": self.name,
+            "unique_id": self.id,
+            "payload_on": "on",
+            "payload_off": "off",
+
+            "current_temperature_topic": self.temperature_state_topic,
+            "mode_state_topic": self.mode_state_topic,
+            "temperature_state_topic": self.target_temperature_state_topic,
+            "fan_mode_state_topic": self.fan_mode_state_topic,
+            "swing_mode_state_topic": self.swing_mode_state_topic,
+            "availability_topic": self.availability_topic,
+            "json_attributes_topic": self.attributes_topic,
+
+            "mode_command_topic": command_topics["mode"],
+            "temperature_command_topic": command_topics["target_temperature"],
+            "fan_mode_command_topic": command_topics["fan_mode"],
+            "swing_mode_command_topic": command_topics["swing_mode"],
+
+            "modes": list(filter(lambda m: m, map(lambda m: self.modes_map.get(m, None), self.modes))),
+            "fan_modes": self.fan_modes,
+            "swing_modes": self.swing_modes,
+            "device": {"identifiers": self.id, "manufacturer": "Hitachi", "model": self.product_name}
+        }
+
+    def outdoor_temp_sensor_mqtt_config(self):
+        return {
+            "name": self.name + " (Outdoor temperature)",
+            "device_class": "temperature",
+            "unit_of_measurement": self.house.config.temperature_unit,
+            "state_topic": self.outdoor_temperature_state_topic,
+            "json_attributes_topic": self.attributes_topic
+        }
+
+    def discovery_messages(self):
+        return [
+            (self.climate_discovery_topic, json.dumps(self.climate_mqtt_config())),
+            (self.outdoor_temp_sensor_discovery_topic, json.dumps(self.outdoor_temp_sensor_mqtt_config()))
+        ]
+
+    def publish_discovery(self, messages):
+        mqtt_client = self.house.mqtt_client
+        retain = self.house.config.mqtt_config_retain
+        for topic, payload in messages:
+            mqtt_client.publish(topic, payload, qos=1, retain=retain)
+        self.discovery_hash = hash(tuple(messages))
+
+    def unregister_mqtt(self):
+        mqtt_client = self.house.mqtt_client
+
+        # TODO leave_home_state?
+
+        if self.house.config.mqtt_discovery:
+            retain = self.house.config.mqtt_config_retain
+            mqtt_client.publish(self.climate_discovery_topic, None, retain=retain)
+            mqtt_client.publish(self.outdoor_temp_sensor_discovery_topic, None, retain=retain)
+        self.discovery_hash = None
+
+    def on_command(self, attr, value):
+        # The next setup must be applied even if Hi-Kumo did not change it, to reconcile the commanded state
+        self.house.setup_up_to_date = False
+        if not self.state_dirty:
+            self.command_received = time.time()
+            if self.pending_execution is None and self.rollback_state is None:
+                self.rollback_state = [getattr(self, name) for name in self.commanded_attributes]
+        # Refreshed as soon as the command has run, then slowing down again
+        self.refresh_delayer.reset()
+        self.next_refresh = 0
+        self.state_dirty = True
+        # The local state no longer matches the last raw states received from Hi-Kumo
+        self.raw_states = {}
+        if attr == "mode":
+            if value == "off":
+                self.power_state = "off"
+            else:
+                self.power_state = "on"
+                setattr(self, attr, self.read_mode(value))
+        else:
+            setattr(self, attr, value)
+        self.house.scheduler.submit(self)
+
+    # Restores and publishes the state from before the commands, when Hi-Kumo did not apply them. Nothing is restored
+    # when newer commands are waiting to be sent.
+    def rollback(self):
+        if self.state_dirty or self.pending_execution is not None or self.rollback_state is None:
+            return
+        for name, value in zip(self.commanded_attributes, self.rollback_state):
+            setattr(self, name, value)
+        self.rollback_state = None
+        self.publish_state()
+
+    # The commands could not be queued: they are not sent again later and the state from before them is restored
+    def drop_commands(self):
+        self.state_dirty = False
+        self.command_sent = time.time()
+        self.house.journal.discard([self])
+        self.rollback()
+
+    # Builds the exec/apply action that sends the local state to Hi-Kumo, and marks the state as clean
+    def command_action(self):
+        self.state_dirty = False
+        self.command_sent = time.time()
+        self.pending_execution = ""  # until exec/apply returns the execution id
+        return {
+            "commands": [{
+                "name": "globalControl",
+                "parameters": [
+                    self.power_state,
+                    self.target_temperature,
+                    self.fan_mode,
+                    self.mode,
+                    self.swing_mode,
+                    "off"  # TODO ? find out what this argument is. It is not leave_home_state
+                ]
+            }],
+            "deviceURL": self.command_url
+        }
+
+    # Translates the internal mode into HA mode
+    def sanitize_mode(self):
+        if self.power_state == "off":
+            return "off"
+        else:
+            return self.modes_map.get(self.mode, "auto")
+
+    # Translates HA mode into internal mode
+    def read_mode(self, mode):
+        return self.rev_modes_map.get(mode, "auto")
+
+    def state_payloads(self):
+        return [
+            (self.temperature_state_topic, "temperature", self.temperature),
+            (self.mode_state_topic, "mode", self.sanitize_mode()),
+            (self.target_temperature_state_topic, "target_temperature", self.target_temperature),
+            (self.fan_mode_state_topic, "fan_mode", self.fan_mode),
+            (self.swing_mode_state_topic, "swing_mode", self.swing_mode),
+            (self.availability_topic, "available", self.available),
+            # Temperature sensors work better as float in HA, even though Hi-Kumo rounds it as an int
+            (self.outdoor_temperature_state_topic, "outdoor_temperature", float(self.outdoor_temperature)),
+            (self.attributes_topic, "attributes", self.attributes_payload())
+        ]
+
+    # Tells whether the state was restored from the snapshot, and from when, rather than received from Hi-Kumo. The
+    # time is left out of the live state, which would otherwise be published again on every refresh.
+    def attributes_payload(self):
+        if self.stale:
+            return json.dumps({"stale": True, "last_update": round(self.last_update)})
+        return json.dumps({"stale": False})
+
+    def has_changed(self, attr, last_payload, payload):
+        deadband = self.house.config.publish_deadband.get(attr, 0)
+        if deadband and isinstance(payload, (int, float)) and isinstance(last_payload, (int, float)):
+            return abs(payload - last_payload) >= deadband
+        return payload != last_payload
+
+    def reset_published(self):
+        self.published = {}
+        self.last_full_publish = 0
+
+    def publish_state(self):
+        mqtt_client = self.house.mqtt_client
+        retain = self.house.config.mqtt_state_retain
+        if mqtt_client is not None:
+            stats = self.house.publish_stats
+            now = time.time()
+            # Everything is re-published on every heartbeat, otherwise only the values that changed are
+            full = (not self.house.config.publish_on_change
+                    or now - self.last_full_publish >= self.house.config.publish_heartbeat)
+            if full:
+                self.last_full_publish = now
+            for topic, attr, payload in self.state_payloads():
+                if not full and topic in self.published and not self.has_changed(attr, self.published[topic], payload):
+                    stats["suppressed"] += 1
+                    continue
+                mqtt_client.publish(topic, payload, retain=retain)
+                self.published[topic] = payload
+                stats["sent"] += 1
+
+
+################
+
+class Config:
+    name = ""
+    api_username = None
+    api_password = None
+    api_url = "https://ha117-1.overkiz.com/enduser-mobile-web/enduserAPI"
+    api_user_agent = 'aasivak'
+    mqtt_discovery_prefix = "homeassistant"
+    mqtt_state_prefix = "hikumo/state"
+    mqtt_command_prefix = "hikumo/command"
+    mqtt_reset_topic = "hikumo/reset"
+    mqtt_profile_topic = "hikumo/profile"
+    mqtt_host = "127.0.0.1"
+    mqtt_port = 1883
+    mqtt_discovery = True
+    mqtt_discovery_batch_size = 20
+    mqtt_discovery_batch_delay = 0.1
+    mqtt_wildcard_subscribe = True
+    mqtt_config_retain = True
+    mqtt_state_retain = True
+    mqtt_username = None
+    mqtt_password = None
+    http_proxy = None
+    https_proxy = None
+    http_pool_connections = 10
+    http_pool_maxsize = 10
+    http_keep_alive = True
+    mqtt_client_name = "aasivak"
+    logging_level = "INFO"
+    action_delay = 0.5
+    command_queue_size = 100
+    refresh_delays = [3, 5, 10, 30]
+    refresh_delay_randomness = 2
+    api_retries = 1
+    api_retry_delay = 1
+    api_retry_max_delay = 30
+    breaker_failure_threshold = 3
+    breaker_reset_timeout = 60
+    temperature_unit = "°C"
+    snapshot_file = None
+    snapshot_delay = 60
+    metrics_host = "127.0.0.1"
+    metrics_port = None
+    publish_on_change = True
+    publish_heartbeat = 300
+    publish_deadband = {}
+    event_loop = "threads"
+    sync_mode = "poll"
+    state_refresh = "setup"
+    event_fetch_delay = 1
+    setup_check_delay = 300
+    optimistic_state = True
+    idle_refresh_delay = 120
+    api_budget = 120
+    execution_timeout = 60
+    command_journal_file = None
+    session_file = None
+    session_lifetime = 3600
+    command_max_age = 3600
+    command_retry_delay = 10
+    command_retry_max_delay = 300
+    setup_parser = "json"
+    local_gateways = {}
+    record_file = None
+    replay_file = None
+    replay_speed = 1
+    profile_dir = "profiles"
+    profile_duration = 30
+    profile_interval = 0.01
+    slow_cycle_threshold = 5
+
+    def __init__(self, raw):
+        self.name = raw.get("name", self.name)
+        # Only required for an account: with several accounts, each of them can carry its own credentials
+        self.api_username = raw.get("api_username", self.api_username)
+        self.api_password = raw.get("api_password", self.api_password)
+        self.api_url = raw.get("api_url", self.api_url)
+        self.api_user_agent = raw.get("api_user_agent", self.api_user_agent)
+        self.mqtt_discovery_prefix = raw.get("mqtt_discovery_prefix", self.mqtt_discovery_prefix)
+        self.mqtt_state_prefix = raw.get("mqtt_state_prefix", self.mqtt_state_prefix)
+        self.mqtt_command_prefix = raw.get("mqtt_command_prefix", self.mqtt_command_prefix)
+        self.mqtt_reset_topic = raw.get("mqtt_reset_topic", self.mqtt_reset_topic)
+        self.mqtt_profile_topic = raw.get("mqtt_profile_topic", self.mqtt_profile_topic)
+        self.mqtt_host = raw.get("mqtt_host", self.mqtt_host)
+        self.mqtt_port = raw.get("mqtt_port", self.mqtt_port)
+        self.mqtt_discovery = raw.get("mqtt_discovery", self.mqtt_discovery)
+        self.mqtt_discovery_batch_size = raw.get("mqtt_discovery_batch_size", self.mqtt_discovery_batch_size)
+        self.mqtt_discovery_batch_delay = raw.get("mqtt_discovery_batch_delay", self.mqtt_discovery_batch_delay)
+        self.mqtt_wildcard_subscribe = raw.get("mqtt_wildcard_subscribe", self.mqtt_wildcard_subscribe)
+        self.mqtt_config_retain = raw.get("mqtt_config_retain", self.mqtt_config_retain)
+        self.mqtt_state_retain = raw.get("mqtt_state_retain", self.mqtt_state_retain)
+        self.mqtt_username = raw.get("mqtt_username", self.mqtt_username)
+        self.mqtt_password = raw.get("mqtt_password", self.mqtt_password)
+        self.http_proxy = raw.get("http_proxy", self.http_proxy)
+        self.https_proxy = raw.get("https_proxy", self.https_proxy)
+        self.http_pool_connections = raw.get("http_pool_connections", self.http_pool_connections)
+        self.http_pool_maxsize = raw.get("http_pool_maxsize", self.http_pool_maxsize)
+        self.http_keep_alive = raw.get("http_keep_alive", self.http_keep_alive)
+        self.mqtt_client_name = raw.get("mqtt_client_name", self.mqtt_client_name)
+        self.logging_level = raw.get("logging_level", self.logging_level)
+        self.action_delay = raw.get("action_delay", self.action_delay)
+        self.command_queue_size = raw.get("command_queue_size", self.command_queue_size)
+        self.refresh_delays = raw.get("refresh_delays", self.refresh_delays)
+        self.refresh_delay_randomness = raw.get("refresh_delay_randomness", self.refresh_delay_randomness)
+        self.temperature_unit = raw.get("temperature_unit",self.temperature_unit)
+        self.api_retries = raw.get("api_retries", self.api_retries)
+        self.api_retry_delay = raw.get("api_retry_delay", self.api_retry_delay)
+        self.api_retry_max_delay = raw.get("api_retry_max_delay", self.api_retry_max_delay)
+        self.breaker_failure_threshold = raw.get("breaker_failure_threshold", self.breaker_failure_threshold)
+        self.breaker_reset_timeout = raw.get("breaker_reset_timeout", self.breaker_reset_timeout)
+        self.snapshot_file = raw.get("snapshot_file", self.snapshot_file)
+        self.snapshot_delay = raw.get("snapshot_delay", self.snapshot_delay)
+        self.metrics_host = raw.get("metrics_host", self.metrics_host)
+        self.metrics_port = raw.get("metrics_port", self.metrics_port)
+        self.publish_on_change = raw.get("publish_on_change", self.publish_on_change)
+        self.publish_heartbeat = raw.get("publish_heartbeat", self.publish_heartbeat)
+        self.publish_deadband = raw.get("publish_deadband", self.publish_deadband) or {}
+        self.event_loop = raw.get("event_loop", self.event_loop)
+        self.sync_mode = raw.get("sync_mode", self.sync_mode)
+        self.state_refresh = raw.get("state_refresh", self.state_refresh)
+        self.event_fetch_delay = raw.get("event_fetch_delay", self.event_fetch_delay)
+        self.setup_check_delay = raw.get("setup_check_delay", self.setup_check_delay)
+        self.optimistic_state = raw.get("optimistic_state", self.optimistic_state)
+        self.idle_refresh_delay = raw.get("idle_refresh_delay", self.idle_refresh_delay)
+        self.api_budget = raw.get("api_budget", self.api_budget)
+        # The per device refresh cadence and the API budget only apply to the "devices" refresh mode
+        self.unused_keys = [key for key in ("idle_refresh_delay", "api_budget")
+                            if key in raw and self.state_refresh != "devices"]
+        self.execution_timeout = raw.get("execution_timeout", self.execution_timeout)
+        self.command_journal_file = raw.get("command_journal_file", self.command_journal_file)
+        self.session_file = raw.get("session_file", self.session_file)
+        self.session_lifetime = raw.get("session_lifetime", self.session_lifetime)
+        self.command_max_age = raw.get("command_max_age", self.command_max_age)
+        self.command_retry_delay = raw.get("command_retry_delay", self.command_retry_delay)
+        self.command_retry_max_delay = raw.get("command_retry_max_delay", self.command_retry_max_delay)
+        self.setup_parser = raw.get("setup_parser", self.setup_parser)
+        self.local_gateways = raw.get("local_gateways", self.local_gateways) or {}
+        self.record_file = raw.get("record_file", self.record_file)
+        self.replay_file = raw.get("replay_file", self.replay_file)
+        self.replay_speed = raw.get("replay_speed", self.replay_speed)
+        self.profile_dir = raw.get("profile_dir", self.profile_dir)
+        self.profile_duration = raw.get("profile_duration", self.profile_duration)
+        self.profile_interval = raw.get("profile_interval", self.profile_interval)
+        self.slow_cycle_threshold = raw.get("slow_cycle_threshold", self.slow_cycle_threshold)
+        if not isinstance(self.replay_speed, (int, float)) or not 0 < self.replay_speed <= 100:
+            raise ValueError("'replay_speed' must be more than 0 and up to 100, not %r" % (self.replay_speed,))
+        if self.replay_file:
+            self.scale_delays(1.0 / self.replay_speed)
+
+    # A replay runs faster than the recording: the bridge delays are shortened as much, so that it does the same work
+    def scale_delays(self, factor):
+        for name in ("action_delay", "refresh_delay_randomness", "api_retry_delay", "api_retry_max_delay",
+                     "breaker_reset_timeout", "snapshot_delay", "publish_heartbeat", "event_fetch_delay",
+                     "setup_check_delay", "execution_timeout", "idle_refresh_delay", "mqtt_discovery_batch_delay",
+                     "command_max_age", "command_retry_delay", "command_retry_max_delay"):
+            setattr(self, name, getattr(self, name) * factor)
+        self.refresh_delays = [delay * factor for delay in self.refresh_delays]
+        self.api_budget = self.api_budget / factor
+
+    # Fails before anything is started rather than with a rejected login
+    def check_account(self):
+        for key in ("api_username", "api_password"):
+            if not getattr(self, key):
+                if self.name:
+                    raise ValueError("Missing '%s' for account '%s'" % (key, self.name))
+                raise ValueError("Missing '%s' in the configuration" % key)
+
+
+################
+
+class HikumoAdapter:
+    def __init__(self, config, http_adapter=None, recorder=None, replayer=None):
+        self.config = config
+        self.recorder = recorder
+        self.replayer = replayer
+        self.retry_policy = RetryPolicy(config.api_retry_delay, config.api_retry_max_delay)
+        self.cloud = CloudTransport(config)
+        self.breaker = self.cloud.breaker
+        self.local_transports = local_transports(config)
+        self.stats = {"retries": 0, "logins": 0, "rejected": 0}
+        self.request_seconds = 0  # time spent waiting for API responses, for the refresh cycle traces
+        self.session = requests.Session()
+        if http_adapter is None:
+            http_adapter = requests.adapters.HTTPAdapter(pool_connections=config.http_pool_connections,
+                                                         pool_maxsize=config.http_pool_maxsize)
+        # With several accounts, the connection pool is shared while cookies stay in each account's session
+        self.session.mount("https://", http_adapter)
+        self.session.mount("http://", http_adapter)
+        if not config.http_keep_alive:
+            self.session.headers["connection"] = "close"
+        self.session.proxies = {}
+        if config.http_proxy:
+            self.session.proxies["http"] = config.http_proxy
+        if config.https_proxy:
+            self.session.proxies["https"] = config.https_proxy
+        self.stream_setup = is_setup_streamed(config)
+        self.setup_cache = SetupCache()
+        self.session_store = SessionStore(config)
+
+    def request(self, method, url, headers, timeout=(2, 5), **kwargs):
+        started = time.time()
+        try:
+            if self.replayer is not None:
+                return self.replayer.response(method, url, headers)
+            response = self.session.request(method, url=url, headers=headers, timeout=timeout, **kwargs)
+            if self.recorder is not None:
+                self.recorder.api(method, url, response)
+            return response
+        except Exception as e:
+            logging.warning(e)
+            if self.recorder is not None:
+                self.recorder.api(method, url, None)
+            return None
+        finally:
+            self.request_seconds += time.time() - started
+            metrics.observe("aasivak_api_request_duration_seconds", time.time() - started,
+                            {"endpoint": endpoint_label(self.config, url)})
+
+    def get_api(self, url, data, headers, retry=None, **kwargs):
+        return self.call_api("GET", url, headers, retry, data=data, **kwargs)
+
+    def post_api(self, url, data, headers, retry=None, **kwargs):
+        return self.call_api("POST", url, headers, retry, json=data, **kwargs)
+
+    def call_api(self, method, url, headers, retry, transport=None, **kwargs):
+        transport = transport or self.cloud
+        if retry is None:
+            retry = self.config.api_retries
+        if transport.local:
+            # Local calls fail fast, the cloud is the fallback
+            retry = 0
+            headers = transport.authorize(headers)
+            kwargs.update(verify=transport.verify, proxies={"http": None, "https": None})
+        if not transport.breaker.allow():
+            self.stats["rejected"] += 1
+            logging.debug("%s circuit breaker is open, skipping API call to %s", transport.name, url)
+            return None
+        if not transport.local and self.session_store.is_expired() and not self.login():
+            if not transport.breaker.allow():
+                return None
+
+        attempt = 0
+        while True:
+            response = self.request(method, url, headers, **kwargs)
+            outcome = classify_response(response)
+            if outcome == "success":
+                transport.breaker.record_success()
+                # Decoding the body is not free, and a streamed body can only be read once
+                if not kwargs.get("stream", False) and logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug("API response: %s", response.text)
+                return response
+            if outcome == "error" or attempt >= retry:
+                record_failure(transport, outcome, response)
+                return response
+            attempt += 1
+            self.stats["retries"] += 1
+            logging.debug("API call failed with status code %s. Retrying.", status_code(response))
+            if outcome == "auth":
+                self.login()
+            else:
+                time.sleep(self.retry_policy.delay(attempt))
+
+    def login(self):
+        url = self.config.api_url + "/login"
+        data = {'userId': self.config.api_username, 'userPassword': self.config.api_password}
+        headers = {'user-agent': self.config.api_user_agent,
+                   'content-type': 'application/x-www-form-urlencoded; charset=UTF-8'}
+
+        self.stats["logins"] += 1
+        response = self.request("POST", url, headers, timeout=(5, 10), data=data)
+        if classify_response(response) == "transient":
+            self.cloud.breaker.record_failure()
+        else:
+            self.cloud.breaker.record_success()
+        if not is_login_success(response):
+            if is_login_rejected(response):
+                self.session_store.clear()
+            return False
+
+        logging.info("Logged into Hi-Kumo")
+        self.session_store.save([(cookie.name, cookie.value, cookie.domain, cookie.path, cookie.expires)
+                                 for cookie in self.session.cookies])
+        return True
+
+    # Reuses the session saved by the last run when it has not expired, and logs in otherwise
+    def start_session(self):
+        cookies = self.session_store.load() if self.replayer is None else None
+        if cookies is None:
+            return self.login()
+        for name, value, domain, path, expires in cookies:
+            self.session.cookies.set(name, value, domain=domain, path=path, expires=expires)
+        return True
+
+    # Logs in again shortly before the session expires, rather than on the first call refused once it has. Not while the
+    # circuit breaker is open: a login that could not reach Hi-Kumo counts as a failed call.
+    def renew_session(self):
+        if self.session_store.is_expiring() and self.cloud.breaker.allow():
+            self.login()
+
+    # When conditional, returns None if the setup did not change since the last time it was fetched
+    def fetch_api_setup_data(self, conditional=False):
+        url = self.config.api_url + "/setup"
+        data = {}
+        headers = self.setup_cache.headers(self.config, conditional)
+        response = self.get_api(url, data, headers, 1, stream=self.stream_setup)
+        if response is None:
+            return {}
+        elif response.status_code == 304:
+            response.close()
+            return None
+        elif response.status_code != 200:
+            # The error body may not even be JSON, an HTML page from a proxy for instance
+            response.close()
+            return {}
+        elif self.stream_setup:
+            # The body is decompressed and parsed while it is downloaded, and never held in memory as a whole
+            response.raw.decode_content = True
+            stream = HashingStream(response.raw)
+            try:
+                raw_data = parse_setup_stream(stream)
+            except Exception as e:
+                logging.warning("Could not parse the Hi-Kumo setup: %s", e)
+                return {}
+            finally:
+                response.close()
+            return self.setup_cache.check(response, stream.hash.digest(), conditional, raw_data)
+        else:
+            body_hash = hashlib.sha1(response.content).digest()
+            if not self.setup_cache.is_changed(response, body_hash, conditional):
+                return None
+            try:
+                return json.loads(response.content)
+            except ValueError as e:
+                logging.warning("Could not parse the Hi-Kumo setup: %s", e)
+                self.setup_cache.clear()
+                return {}
+
+    def fetch_gateways(self):
+        url = self.config.api_url + "/setup/gateways"
+        headers = {'user-agent': self.config.api_user_agent}
+        response = self.get_api(url, None, headers)
+        return response_json(response, list)
+
+    # The states are read from the local API of the device's gateway when there is one, and from the cloud otherwise
+    def fetch_device_states(self, device_url):
+        transport = self.local_transports.get(urlparse(device_url).netloc, None)
+        if transport is not None:
+            states = self.fetch_device_states_from(transport, device_url)
+            if states is not None:
+                return states
+        return self.fetch_device_states_from(self.cloud, device_url)
+
+    def fetch_device_states_from(self, transport, device_url):
+        url = transport.api_url + "/setup/devices/" + quote(device_url, safe="") + "/states"
+        headers = {'user-agent': self.config.api_user_agent}
+        response = self.get_api(url, None, headers, transport=transport)
+        return response_json(response, list)
+
+    # Sends the actions through the given local transport, or through the cloud when there is none or when it fails.
+    # Returns the response and the transport that sent them, on which their execution can be followed.
+    def apply_actions(self, actions, transport=None):
+        if transport is not None:
+            response = self.apply_actions_with(transport, actions)
+            if execution_id(response) is not None:
+                return response, transport
+            logging.warning("%s API failed, sending the commands through the cloud", transport.name)
+        return self.apply_actions_with(self.cloud, actions), self.cloud
+
+    def apply_actions_with(self, transport, actions):
+        url = transport.api_url + "/exec/apply"
+        data = {
+            "actions": actions,
+            "label": "change air to air heat pump command"
+        }
+        headers = {'content-type': 'application/json; charset=UTF-8',
+                   'user-agent': self.config.api_user_agent}
+        return self.post_api(url, data, headers, transport=transport)
+
+    # Running executions are listed under exec/current. Returns None when Hi-Kumo could not be asked.
+    def is_execution_running(self, exec_id, transport=None):
+        transport = transport or self.cloud
+        url = transport.api_url + "/exec/current/" + exec_id
+        headers = {'user-agent': self.config.api_user_agent}
+        response = self.get_api(url, None, headers, 0, transport=transport)
+        if response is None or classify_response(response) == "transient":
+            return None
+        return is_running_execution(response)
+
+    # Overkiz pushes device and execution state changes to registered event listeners. A listener expires when it is
+    # not fetched for a while, in which case fetch_events returns None and a new one must be registered.
+    def register_event_listener(self):
+        url = self.config.api_url + "/events/register"
+        headers = {'user-agent': self.config.api_user_agent}
+        raw_listener = response_json(self.post_api(url, None, headers, 1), dict)
+        if raw_listener is None:
+            return None
+        listener_id = raw_listener.get("id", None)
+        logging.info("Registered Hi-Kumo event listener %s", listener_id)
+        return listener_id
+
+    def fetch_events(self, listener_id):
+        url = self.config.api_url + "/events/" + listener_id + "/fetch"
+        headers = {'user-agent': self.config.api_user_agent}
+        response = self.post_api(url, None, headers, 0)
+        if response is None or response.status_code != 200:
+            return None
+        # An unreadable fetch does not mean that the listener expired
+        events = response_json(response, list)
+        return [] if events is None else events
+
+
+################
+
+# Commands received on MQTT until Hi-Kumo accepts them, by device and attribute, the last command of an attribute
+# replacing the previous one. When exec/apply cannot reach Hi-Kumo, the devices are deferred and sent again, all at
+# once, with an exponential backoff. With command_journal_file set, the journal is saved at every change so that the
+# commands survive a restart. Commands older than command_max_age are dropped instead of being replayed.
+class CommandJournal:
+    def __init__(self, config):
+        self.config = config
+        self.commands = {}  # device id -> {attribute: [value, time received]}
+        self.deferred = set()  # devices whose commands could not reach Hi-Kumo
+        self.retry_policy = RetryPolicy(config.command_retry_delay, config.command_retry_max_delay)
+        self.retries = 0
+        self.retry_at = 0
+        self.resumed = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def record(self, device, attr, value):
+        with self.lock:
+            self.commands.setdefault(device.id, {})[attr] = [value, time.time()]
+            self.save()
+
+    # Forgets the commands sent to Hi-Kumo, once it accepted or rejected them. The commands received while they were
+    # being sent are kept.
+    def acknowledge(self, devices):
+        with self.lock:
+            self.forget(devices)
+            self.retries = 0
+            self.save()
+
+    # Forgets the commands that were dropped before reaching Hi-Kumo
+    def discard(self, devices):
+        with self.lock:
+            self.forget(devices)
+            self.save()
+
+    def forget(self, devices):
+        for device in devices:
+            self.deferred.discard(device)
+            commands = self.commands.get(device.id, {})
+            for attr in [attr for attr, (value, received) in commands.items() if received <= device.command_sent]:
+                del commands[attr]
+            if not commands:
+                self.commands.pop(device.id, None)
+
+    # Returns the number of seconds before the deferred devices are sent again
+    def defer(self, devices):
+        with self.lock:
+            self.deferred.update(devices)
+            self.retries += 1
+            delay = self.retry_policy.delay(self.retries)
+            self.retry_at = time.time() + delay
+            return delay
+
+    def due_retries(self):
+        with self.lock:
+            if not self.deferred or time.time() < self.retry_at:
+                return []
+            devices = list(self.deferred)
+            self.deferred.clear()
+            return devices
+
+    def retry_delay(self):
+        with self.lock:
+            return max(0, self.retry_at - time.time()) if self.deferred else None
+
+    def has_commands(self, device):
+        with self.lock:
+            self.expire()
+            return device.id in self.commands
+
+    # The commands of each device, when the journal was loaded from a previous run
+    def pending_commands(self):
+        with self.lock:
+            self.expire()
+            return {device_id: {attr: value for attr, (value, received) in commands.items()}
+                    for device_id, commands in self.commands.items()}
+
+    def expire(self):
+        oldest = time.time() - self.config.command_max_age
+        for device_id, commands in list(self.commands.items()):
+            for attr in [attr for attr, (value, received) in commands.items() if received < oldest]:
+                del commands[attr]
+            if not commands:
+                del self.commands[device_id]
+
+    def load(self):
+        if not self.config.command_journal_file:
+            return
+        try:
+            with open(self.config.command_journal_file, 'r', encoding="utf-8") as journal_file:
+                self.commands = json.load(journal_file)["commands"]
+        except (IOError, ValueError, KeyError) as e:
+            logging.debug("No usable command journal: %s", e)
+
+    def save(self):
+        if not self.config.command_journal_file:
+            return
+        temp_file_name = self.config.command_journal_file + ".tmp"
+        try:
+            with open(temp_file_name, 'w', encoding="utf-8") as journal_file:
+                json.dump({"time": time.time(), "commands": self.commands}, journal_file, separators=(",", ":"))
+            os.replace(temp_file_name, self.config.command_journal_file)
+        except IOError as e:
+            logging.warning("Could not save the command journal: %s", e)
+
+
+################
+
+# Collects the devices that received commands during the action_delay window and sends all their states to Hi-Kumo
+# in one single exec/apply call per account, from one single worker thread.
+class CommandScheduler:
+    def __init__(self, config):
+        self.config = config
+        self.queue = queue.Queue(config.command_queue_size)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="aasivak-commands", daemon=True)
+        self.thread.start()
+
+    def submit(self, device):
+        with self.lock:
+            if device.id in self.pending:
+                return
+            try:
+                self.queue.put_nowait(device)
+            except queue.Full:
+                logging.warning("Command queue is full, dropping command for device '%s'", device.name)
+                device.drop_commands()
+                return
+            self.pending.add(device.id)
+
+    def run(self):
+        while True:
+            devices = [self.queue.get()]
+            time.sleep(self.config.action_delay)
+            while True:
+                try:
+                    devices.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self.lock:
+                for device in devices:
+                    self.pending.discard(device.id)
+            try:
+                self.send(devices)
+            except Exception:
+                logging.exception("Could not send the commands for %d device(s)", len(devices))
+
+    def send(self, devices):
+        for house, house_devices in group_dirty_devices(devices).items():
+            for transport, transport_devices in group_by_transport(house.hikumo, house_devices).items():
+                received = [device.command_received for device in transport_devices]
+                actions = [device.command_action() for device in transport_devices]
+                logging.debug("Sending %d device command(s) to Hi-Kumo", len(actions))
+                try:
+                    response, transport = house.hikumo.apply_actions(actions, transport)
+                    house.on_actions_applied(transport_devices, response, transport)
+                except Exception:
+                    # The worker thread must survive any batch: the commands are sent again like when Hi-Kumo is down
+                    logging.exception("Could not send the commands for %d device(s)", len(transport_devices))
+                    house.defer_commands(transport_devices)
+                observe_command_latency(received)
+
+
+def group_dirty_devices(devices):
+    groups = {}
+    for device in devices:
+        if device.state_dirty:
+            groups.setdefault(device.house, []).append(device)
+    return groups
+
+
+# The devices of gateways with a local API are sent to their gateway, all the others to the cloud (key None)
+def group_by_transport(hikumo, devices):
+    groups = {}
+    for device in devices:
+        transport = hikumo.local_transports.get(urlparse(device.command_url).netloc, None)
+        groups.setdefault(transport, []).append(device)
+    return groups
+
+
+# The JSON body of a successful response, or None when it is not of the expected type. An error page from a proxy or
+# a truncated body must not stop the refresh loop.
+def response_json(response, expected_type):
+    if response is None or response.status_code != 200:
+        return None
+    try:
+        data = json.loads(response.text)
+    except ValueError as e:
+        logging.warning("Could not parse the Hi-Kumo response: %s", e)
+        return None
+    if not isinstance(data, expected_type):
+        logging.warning("Unexpected Hi-Kumo response: %s", type(data).__name__)
+        return None
+    return data
+
+
+# exec/apply answers with the id of the execution, or with an error when Hi-Kumo rejected the commands
+def execution_id(response):
+    if response is None or response.status_code != 200:
+        return None
+    try:
+        return json.loads(response.text).get("execId", None)
+    except (ValueError, AttributeError):
+        return None
+
+
+# Hi-Kumo answers a successful login with {"success": true}
+def is_login_success(response):
+    if response is None:
+        logging.warning("Could not log into Hi-Kumo")
+        return False
+    try:
+        success = response.status_code == 200 and json.loads(response.text).get("success", False) is True
+    except (ValueError, AttributeError):
+        success = False
+    if not success:
+        logging.warning("Hi-Kumo login failed with status code %s", response.status_code)
+    return success
+
+
+# Only a refused login discards the saved session: when Hi-Kumo cannot be reached, it may still be valid
+def is_login_rejected(response):
+    return response is not None and (response.status_code in (401, 403) or response.status_code == 200)
+
+
+# The Hi-Kumo session of the last successful login, with the time it is expected to expire: session_lifetime after
+# the login, or earlier when one of its cookies expires earlier. With session_file set, the session cookies are saved,
+# readable by the owner only, so that the next run reuses them instead of logging in again.
+class SessionStore:
+    def __init__(self, config):
+        self.config = config
+        self.expires = None  # None until logged in
+
+    def is_expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+    # The session is renewed in the last tenth of its lifetime
+    def is_expiring(self):
+        return self.expires is not None and time.time() >= self.expires - self.config.session_lifetime / 10
+
+    # cookies: list of (name, value, domain, path, expires)
+    def save(self, cookies):
+        self.expires = min([time.time() + self.config.session_lifetime] +
+                           [expires for name, value, domain, path, expires in cookies if expires])
+        if not self.config.session_file or not cookies:
+            return
+        raw_session = {
+            "api_url": self.config.api_url,
+            "api_username": self.config.api_username,
+            "expires": self.expires,
+            "cookies": cookies
+        }
+        temp_file_name = self.config.session_file + ".tmp"
+        try:
+            descriptor = os.open(temp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, 'w', encoding="utf-8") as session_file:
+                os.chmod(temp_file_name, 0o600)
+                json.dump(raw_session, session_file, separators=(",", ":"))
+            os.replace(temp_file_name, self.config.session_file)
+        except (IOError, OSError) as e:
+            logging.warning("Could not save the Hi-Kumo session: %s", e)
+
+    # Returns the saved cookies, or None when there is no session of this account that has not expired
+    def load(self):
+        if not self.config.session_file:
+            return None
+        try:
+            with open(self.config.session_file, 'r', encoding="utf-8") as session_file:
+                raw_session = json.load(session_file)
+        except (IOError, ValueError) as e:
+            logging.debug("No usable Hi-Kumo session: %s", e)
+            return None
+        if (raw_session.get("api_url", None) != self.config.api_url
+                or raw_session.get("api_username", None) != self.config.api_username
+                or time.time() >= raw_session.get("expires", 0) - self.config.session_lifetime / 10):
+            return None
+        self.expires = raw_session["expires"]
+        logging.info("Reusing the saved Hi-Kumo session, until %s", time.ctime(self.expires))
+        return raw_session["cookies"]
+
+    def clear(self):
+        self.expires = None
+        if not self.config.session_file:
+            return
+        try:
+            os.remove(self.config.session_file)
+        except OSError:
+            pass
+
+
+# A finished execution is no longer found under exec/current
+def is_running_execution(response):
+    if response.status_code != 200:
+        return False
+    try:
+        return bool(json.loads(response.text))
+    except ValueError:
+        return False
+
+
+def observe_command_latency(received):
+    now = time.time()
+    for command_received in received:
+        metrics.observe("aasivak_command_duration_seconds", now - command_received)
+
+
+################
+
+# The APIs that HikumoAdapter talks to. The cloud API authenticates with the session cookie set by /login. The local
+# API of a gateway (Overkiz developer mode) is reached over the LAN with a bearer token, and the gateway certificate
+# is self-signed. Each API has its own circuit breaker.
+class CloudTransport:
+    local = False
+
+    def __init__(self, config):
+        self.name = "Hi-Kumo"
+        self.api_url = config.api_url
+        self.verify = True
+        self.ssl = True
+        self.breaker = CircuitBreaker(config.breaker_failure_threshold, config.breaker_reset_timeout)
+
+    def authorize(self, headers):
+        return headers
+
+
+class LocalTransport:
+    local = True
+
+    def __init__(self, config, gateway_id, raw):
+        self.name = "Local " + gateway_id
+        self.api_url = raw["url"]
+        self.token = raw["token"]
+        # False, or the path of the certificate authority that signed the gateway certificate
+        self.verify = raw.get("verify", False)
+        self.ssl = ssl.create_default_context(cafile=self.verify) if isinstance(self.verify, str) else self.verify
+        self.breaker = CircuitBreaker(config.breaker_failure_threshold, config.breaker_reset_timeout)
+
+    def authorize(self, headers):
+        headers = dict(headers)
+        headers["authorization"] = "Bearer " + self.token
+        return headers
+
+
+def local_transports(config):
+    transports = {}
+    for gateway_id, raw in config.local_gateways.items():
+        transports[gateway_id] = LocalTransport(config, gateway_id, raw)
+        if raw.get("verify", False) is False:
+            requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+        logging.info("Using the local API of gateway %s at %s", gateway_id, raw["url"])
+    return transports
+
+
+# Tells apart the failures that need a new session from the transient ones that only need to be retried later
+def classify_response(response):
+    if response is None:
+        return "transient"  # timeout or connection error
+    if response.status_code in (200, 304):
+        return "success"
+    if response.status_code in (401, 403):
+        return "auth"
+    if response.status_code == 429 or response.status_code >= 500:
+        return "transient"
+    return "error"
+
+
+def status_code(response):
+    return -1 if response is None else response.status_code
+
+
+def record_failure(transport, outcome, response):
+    if outcome == "transient" or (outcome == "auth" and transport.local):
+        # A gateway refusing its token is of no use until the token is fixed
+        transport.breaker.record_failure()
+        logging.warning("%s API call failed with status code %s. No more retry.", transport.name,
+                        status_code(response))
+    else:
+        # The API answered: this is not an outage
+        transport.breaker.record_success()
+        logging.warning("%s API call failed with status code %s.", transport.name, status_code(response))
+
+
+# Exponential backoff with full jitter
+class RetryPolicy:
+    def __init__(self, base_delay, max_delay):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+# Token bucket capping the number of refresh API calls of an account: per_minute calls per minute on average, with
+# bursts of up to a sixth of that
+class RequestBudget:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, per_minute / 6.0)
+        self.tokens = self.capacity
+        self.last_refill = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    # Seconds until the next call is allowed
+    def wait_time(self):
+        self.refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+# Fails fast while the Hi-Kumo cloud is down: opens after failure_threshold consecutive failed calls, then lets one
+# single probe call through every reset_timeout seconds until one succeeds.
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                logging.info("Hi-Kumo API is reachable again, closing circuit breaker")
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                if self.state == "closed":
+                    self.trips += 1
+                    logging.warning("Hi-Kumo API is unreachable, opening circuit breaker for %ss", self.reset_timeout)
+                self.state = "open"
+                self.opened_at = time.time()
+
+
+################
+
+# Incremental /setup parser for setup_parser: stream, based on the optional ijson package. Only the gateways and the
+# climate devices are built, with only the states and definitions read by Device: memory and parse time depend on the
+# number of climate units rather than on the size of the Hi-Kumo account.
+def is_setup_streamed(config):
+    # Recordings need the whole body, and replays have no stream to parse
+    if config.setup_parser != "stream" or config.record_file or config.replay_file:
+        return False
+    return has_ijson()
+
+
+def has_ijson():
+    try:
+        import ijson
+    except ImportError:
+        logging.warning("setup_parser is stream but ijson is not installed, falling back to the json parser")
+        return False
+    return True
+
+
+def parse_setup_stream(stream):
+    import ijson
+
+    setup_filter = SetupFilter()
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        setup_filter.feed(prefix, event, value)
+    return setup_filter.setup
+
+
+async def parse_setup_stream_async(stream):
+    import ijson
+
+    setup_filter = SetupFilter()
+    async for prefix, event, value in ijson.parse_async(stream, use_float=True):
+        setup_filter.feed(prefix, event, value)
+    return setup_filter.setup
+
+
+async def parse_hashed_setup_stream_async(stream):
+    stream = AsyncHashingStream(stream)
+    return await parse_setup_stream_async(stream), stream.hash.digest()
+
+
+# Hash of a body computed while it is parsed
+class HashingStream:
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hash.update(data)
+        return data
+
+
+class AsyncHashingStream(HashingStream):
+    async def read(self, size=-1):
+        data = await self.stream.read(size)
+        self.hash.update(data)
+        return data
+
+
+# Most /setup fetches return the same setup as the previous one. The validators of the last response are sent back so
+# that Hi-Kumo can answer with a 304 when it supports them, and the body hash of the last response tells when it did
+# not change otherwise. Either way, parsing and updating the devices can be skipped.
+class SetupCache:
+    def __init__(self):
+        self.etag = None
+        self.last_modified = None
+        self.body_hash = None
+
+    def headers(self, config, conditional):
+        headers = {'user-agent': config.api_user_agent, 'accept-encoding': 'gzip, deflate'}
+        if conditional and self.etag is not None:
+            headers['if-none-match'] = self.etag
+        if conditional and self.last_modified is not None:
+            headers['if-modified-since'] = self.last_modified
+        return headers
+
+    def is_changed(self, response, body_hash, conditional):
+        if response.status_code != 200:
+            return True
+        self.etag = response.headers.get("etag", None)
+        self.last_modified = response.headers.get("last-modified", None)
+        changed = body_hash != self.body_hash
+        self.body_hash = body_hash
+        if not changed and conditional:
+            logging.debug("Hi-Kumo setup did not change")
+        return changed or not conditional
+
+    # A streamed body is only known once parsed
+    def check(self, response, body_hash, conditional, raw_data):
+        return raw_data if self.is_changed(response, body_hash, conditional) else None
+
+    # A body that could not be parsed must not be taken for the last setup
+    def clear(self):
+        self.etag = None
+        self.last_modified = None
+        self.body_hash = None
+
+
+# Whether a request carries the validators of a previous response, and may be answered with a 304
+def is_conditional(headers):
+    return bool(headers) and ("if-none-match" in headers or "if-modified-since" in headers)
+
+
+class SetupFilter:
+    device_keys = {"devices.item.oid", "devices.item.label", "devices.item.deviceURL", "devices.item.type"}
+    built_prefixes = {"gateways.item", "devices.item.states.item", "devices.item.definition.states.item"}
+
+    def __init__(self):
+        from ijson.common import ObjectBuilder
+
+        self.object_builder = ObjectBuilder
+        self.setup = {}
+        self.device = None
+        self.builder = None
+        self.builder_prefix = None
+
+    def feed(self, prefix, event, value):
+        if self.builder is not None:
+            self.builder.event(event, value)
+            if prefix == self.builder_prefix and event == "end_map":
+                self.on_built(prefix, self.builder.value)
+                self.builder = None
+        elif event == "start_map" and prefix in self.built_prefixes and (self.device is not None
+                                                                        or prefix == "gateways.item"):
+            self.builder = self.object_builder()
+            self.builder_prefix = prefix
+            self.builder.event(event, value)
+        elif prefix == "devices.item":
+            if event == "start_map":
+                self.device = {"definition": {"states": []}, "states": []}
+            elif event == "end_map":
+                if self.device.get("type", None) == 1:
+                    self.setup["devices"].append(self.device)
+                self.device = None
+        elif prefix in self.device_keys and self.device is not None:
+            self.device[prefix[len("devices.item."):]] = value
+        elif prefix in ("gateways", "devices") and event == "start_array":
+            self.setup[prefix] = []
+
+    def on_built(self, prefix, value):
+        if prefix == "gateways.item":
+            self.setup["gateways"].append(value)
+        elif prefix == "devices.item.states.item":
+            if value.get("name", None) in Device.raw_state_attributes:
+                self.device["states"].append(value)
+        elif value.get("qualifiedName", None) in Device.raw_definition_attributes:
+            self.device["definition"]["states"].append(value)
+
+
+################
+
+# Mirror of HikumoAdapter for the asyncio event loop, based on aiohttp
+class AsyncHikumoAdapter:
+    def __init__(self, config, connector=None, recorder=None, replayer=None):
+        import aiohttp
+
+        self.check_config(config)
+        self.config = config
+        self.recorder = recorder
+        self.replayer = replayer
+        self.retry_policy = RetryPolicy(config.api_retry_delay, config.api_retry_max_delay)
+        self.cloud = CloudTransport(config)
+        self.breaker = self.cloud.breaker
+        self.local_transports = local_transports(config)
+        self.stats = {"retries": 0, "logins": 0, "rejected": 0}
+        self.request_seconds = 0
+        if connector is None:
+            connector = async_connector(config)
+            connector_owner = True
+        else:
+            connector_owner = False
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(sock_connect=2, sock_read=5),
+                                             connector=connector, connector_owner=connector_owner)
+        self.proxy = config.https_proxy or config.http_proxy
+        self.stream_setup = is_setup_streamed(config)
+        self.setup_cache = SetupCache()
+        self.session_store = SessionStore(config)
+
+    # aiohttp does not support socks proxies, only http ones
+    @staticmethod
+    def check_config(config):
+        proxy = config.https_proxy or config.http_proxy
+        if proxy and urlparse(proxy).scheme.startswith("socks"):
+            raise ValueError("event_loop 'asyncio' does not support the socks proxy '%s', use 'threads' instead"
+                             % urlparse(proxy).hostname)
+
+    async def close(self):
+        await self.session.close()
+
+    # A successful response body is given to the reader coroutine as a stream when there is one
+    async def request(self, method, url, headers, reader=None, **kwargs):
+        started = time.time()
+        try:
+            if self.replayer is not None:
+                return self.replayer.response(method, url, headers)
+            kwargs.setdefault("proxy", self.proxy)
+            async with self.session.request(method, url, headers=headers, **kwargs) as response:
+                if reader is not None and response.status == 200:
+                    return ApiResponse(response.status, None, await reader(response.content), response.headers)
+                api_response = ApiResponse(response.status, await response.text(), headers=response.headers)
+            if self.recorder is not None:
+                self.recorder.api(method, url, api_response)
+            return api_response
+        except Exception as e:
+            logging.warning(e)
+            if self.recorder is not None:
+                self.recorder.api(method, url, None)
+            return None
+        finally:
+            self.request_seconds += time.time() - started
+            metrics.observe("aasivak_api_request_duration_seconds", time.time() - started,
+                            {"endpoint": endpoint_label(self.config, url)})
+
+    async def get_api(self, url, data, headers, retry=None, **kwargs):
+        return await self.call_api("GET", url, headers, retry, data=data, **kwargs)
+
+    async def post_api(self, url, data, headers, retry=None, **kwargs):
+        return await self.call_api("POST", url, headers, retry, json=data, **kwargs)
+
+    async def call_api(self, method, url, headers, retry, transport=None, **kwargs):
+        import asyncio
+
+        transport = transport or self.cloud
+        if retry is None:
+            retry = self.config.api_retries
+        if transport.local:
+            retry = 0
+            headers = transport.authorize(headers)
+            kwargs.update(ssl=transport.ssl, proxy=None)
+        if not transport.breaker.allow():
+            self.stats["rejected"] += 1
+            logging.debug("%s circuit breaker is open, skipping API call to %s", transport.name, url)
+            return None
+        if not transport.local and self.session_store.is_expired() and not await self.login():
+            if not transport.breaker.allow():
+                return None
+
+        attempt = 0
+        while True:
+            response = await self.request(method, url, headers, **kwargs)
+            outcome = classify_response(response)
+            if outcome == "success":
+                transport.breaker.record_success()
+                if response.text is not None:
+                    logging.debug("API response: %s", response.text)
+                return response
+            if outcome == "error" or attempt >= retry:
+                record_failure(transport, outcome, response)
+                return response
+            attempt += 1
+            self.stats["retries"] += 1
+            logging.debug("API call failed with status code %s. Retrying.", status_code(response))
+            if outcome == "auth":
+                await self.login()
+            else:
+                await asyncio.sleep(self.retry_policy.delay(attempt))
+
+    async def login(self):
+        url = self.config.api_url + "/login"
+        data = {'userId': self.config.api_username, 'userPassword': self.config.api_password}
+        headers = {'user-agent': self.config.api_user_agent,
+                   'content-type': 'application/x-www-form-urlencoded; charset=UTF-8'}
+
+        self.stats["logins"] += 1
+        response = await self.request("POST", url, headers, data=data)
+        if classify_response(response) == "transient":
+            self.cloud.breaker.record_failure()
+        else:
+            self.cloud.breaker.record_success()
+        if not is_login_success(response):
+            if is_login_rejected(response):
+                self.session_store.clear()
+            return False
+
+        logging.info("Logged into Hi-Kumo")
+        self.session_store.save([(morsel.key, morsel.value, morsel["domain"], morsel["path"], None)
+                                 for morsel in self.session.cookie_jar])
+        return True
+
+    async def start_session(self):
+        from http.cookies import SimpleCookie
+        from yarl import URL
+
+        cookies = self.session_store.load() if self.replayer is None else None
+        if cookies is None:
+            return await self.login()
+        for name, value, domain, path, expires in cookies:
+            cookie = SimpleCookie()
+            cookie[name] = value
+            cookie[name]["path"] = path or "/"
+            if domain:
+                cookie[name]["domain"] = domain
+            self.session.cookie_jar.update_cookies(cookie, URL(self.config.api_url))
+        return True
+
+    async def renew_session(self):
+        if self.session_store.is_expiring() and self.cloud.breaker.allow():
+            await self.login()
+
+    async def fetch_api_setup_data(self, conditional=False):
+        url = self.config.api_url + "/setup"
+        headers = self.setup_cache.headers(self.config, conditional)
+        if self.stream_setup:
+            response = await self.get_api(url, None, headers, 1, reader=parse_hashed_setup_stream_async)
+        else:
+            response = await self.get_api(url, None, headers, 1)
+        if response is None:
+            return {}
+        elif response.status_code == 304:
+            return None
+        elif response.status_code != 200:
+            return {}
+        elif response.data is not None:
+            raw_data, body_hash = response.data
+            return self.setup_cache.check(response, body_hash, conditional, raw_data)
+        else:
+            body_hash = hashlib.sha1(response.content).digest()
+            if not self.setup_cache.is_changed(response, body_hash, conditional):
+                return None
+            try:
+                return json.loads(response.text)
+            except ValueError as e:
+                logging.warning("Could not parse the Hi-Kumo setup: %s", e)
+                self.setup_cache.clear()
+                return {}
+
+    async def fetch_gateways(self):
+        url = self.config.api_url + "/setup/gateways"
+        headers = {'user-agent': self.config.api_user_agent}
+        response = await self.get_api(url, None, headers)
+        return response_json(response, list)
+
+    async def fetch_device_states(self, device_url):
+        transport = self.local_transports.get(urlparse(device_url).netloc, None)
+        if transport is not None:
+            states = await self.fetch_device_states_from(transport, device_url)
+            if states is not None:
+                return states
+        return await self.fetch_device_states_from(self.cloud, device_url)
+
+    async def fetch_device_states_from(self, transport, device_url):
+        url = transport.api_url + "/setup/devices/" + quote(device_url, safe="") + "/states"
+        headers = {'user-agent': self.config.api_user_agent}
+        response = await self.get_api(url, None, headers, transport=transport)
+        return response_json(response, list)
+
+    async def apply_actions(self, actions, transport=None):
+        if transport is not None:
+            response = await self.apply_actions_with(transport, actions)
+            if execution_id(response) is not None:
+                return response, transport
+            logging.warning("%s API failed, sending the commands through the cloud", transport.name)
+        return await self.apply_actions_with(self.cloud, actions), self.cloud
+
+    async def apply_actions_with(self, transport, actions):
+        url = transport.api_url + "/exec/apply"
+        data = {
+            "actions": actions,
+            "label": "change air to air heat pump command"
+        }
+        headers = {'content-type': 'application/json; charset=UTF-8',
+                   'user-agent': self.config.api_user_agent}
+        return await self.post_api(url, data, headers, transport=transport)
+
+    async def is_execution_running(self, exec_id, transport=None):
+        transport = transport or self.cloud
+        url = transport.api_url + "/exec/current/" + exec_id
+        headers = {'user-agent': self.config.api_user_agent}
+        response = await self.get_api(url, None, headers, 0, transport=transport)
+        if response is None or classify_response(response) == "transient":
+            return None
+        return is_running_execution(response)
+
+    async def register_event_listener(self):
+        url = self.config.api_url + "/events/register"
+        headers = {'user-agent': self.config.api_user_agent}
+        raw_listener = response_json(await self.post_api(url, None, headers, 1), dict)
+        if raw_listener is None:
+            return None
+        listener_id = raw_listener.get("id", None)
+        logging.info("Registered Hi-Kumo event listener %s", listener_id)
+        return listener_id
+
+    async def fetch_events(self, listener_id):
+        url = self.config.api_url + "/events/" + listener_id + "/fetch"
+        headers = {'user-agent': self.config.api_user_agent}
+        response = await self.post_api(url, None, headers, 0)
+        if response is None or response.status_code != 200:
+            return None
+        # An unreadable fetch does not mean that the listener expired
+        events = response_json(response, list)
+        return [] if events is None else events
+
+
+class ApiResponse:
+    def __init__(self, status_code, text, data=None, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.data = data  # parsed body, when it was parsed while downloaded
+        self.headers = headers or {}
+
+    @property
+    def content(self):
+        return self.text.encode("utf-8")
+
+    def close(self):
+        pass
+
+
+def async_connector(config):
+    import aiohttp
+
+    return aiohttp.TCPConnector(limit=config.http_pool_maxsize, force_close=not config.http_keep_alive)
+
+
+################
+
+# Mirror of CommandScheduler for the asyncio event loop: a single delayed task flushes all the pending devices
+class AsyncCommandScheduler:
+    def __init__(self, config):
+        self.config = config
+        self.pending = {}
+        self.flush_task = None
+
+    def submit(self, device):
+        import asyncio
+
+        if device.id in self.pending:
+            return
+        if len(self.pending) >= self.config.command_queue_size:
+            logging.warning("Command queue is full, dropping command for device '%s'", device.name)
+            device.drop_commands()
+            return
+        self.pending[device.id] = device
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        import asyncio
+
+        await asyncio.sleep(self.config.action_delay)
+        devices = list(self.pending.values())
+        self.pending = {}
+        self.flush_task = None
+        for house, house_devices in group_dirty_devices(devices).items():
+            for transport, transport_devices in group_by_transport(house.hikumo, house_devices).items():
+                received = [device.command_received for device in transport_devices]
+                actions = [device.command_action() for device in transport_devices]
+                logging.debug("Sending %d device command(s) to Hi-Kumo", len(actions))
+                try:
+                    response, transport = await house.hikumo.apply_actions(actions, transport)
+                    house.on_actions_applied(transport_devices, response, transport)
+                except Exception:
+                    logging.exception("Could not send the commands for %d device(s)", len(transport_devices))
+                    house.defer_commands(transport_devices)
+                observe_command_latency(received)
+
+
+################
+
+# Drives the paho network loop from the asyncio event loop instead of paho's own thread
+class MqttAsyncioHelper:
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.misc_task = None
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+            self.misc_task = None
+        self.loop.call_later(1, self.reconnect)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        import asyncio
+
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def reconnect(self):
+        try:
+            self.client.reconnect()
+        except Exception as e:
+            logging.warning("MQTT reconnection failed: %s", e)
+            self.loop.call_later(5, self.reconnect)
+
+
+################
+
+class Delayer:
+    def __init__(self, delays, randomness):
+        self.delays = delays
+        self.delay_index = 0
+        self.randomness = randomness
+
+    def reset(self):
+        self.delay_index = 0
+
+    def next(self):
+        delay = self.delays[self.delay_index] + self.randomness * (random.random() - .5)
+        self.delay_index = min(len(self.delays) - 1, self.delay_index + 1)
+        return delay
+
+    # Keeps the last delay for the next time instead of moving on, or goes back one step from the longest delay
+    def speed_up(self):
+        self.delay_index = max(0, self.delay_index - 1)
+
+
+################
+
+# Minimal Prometheus registry: counters and histograms updated in the hot paths, plus collectors called at scrape time
+class Metrics:
+    duration_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+    descriptions = {
+        "aasivak_api_request_duration_seconds": ("histogram", "Duration of the Hi-Kumo API requests"),
+        "aasivak_refresh_duration_seconds": ("histogram", "Duration of the refresh cycles"),
+        "aasivak_refresh_phase_seconds": ("histogram", "Time spent in each phase of the refresh cycles"),
+        "aasivak_command_duration_seconds": ("histogram", "Time from an MQTT command to exec/apply completing"),
+        "aasivak_executions_total": ("counter", "Hi-Kumo executions of the commands sent, by final state"),
+        "aasivak_refresh_deferred_total": ("counter",
+                                           "Refresh cycles that postponed due devices to stay within api_budget"),
+        "aasivak_mqtt_messages_received_total": ("counter", "MQTT messages received"),
+        "aasivak_mqtt_messages_published_total": ("counter", "MQTT state messages published"),
+        "aasivak_mqtt_messages_suppressed_total": ("counter", "MQTT state messages not published because unchanged"),
+        "aasivak_api_retries_total": ("counter", "Hi-Kumo API call retries"),
+        "aasivak_api_logins_total": ("counter", "Hi-Kumo logins"),
+        "aasivak_api_rejected_total": ("counter", "Hi-Kumo API calls rejected by the open circuit breaker"),
+        "aasivak_circuit_breaker_open": ("gauge", "1 when the Hi-Kumo circuit breaker is open"),
+        "aasivak_circuit_breaker_trips_total": ("counter", "Number of times the Hi-Kumo circuit breaker opened"),
+        "aasivak_device_staleness_seconds": ("gauge", "Seconds since the device state was last received from Hi-Kumo")
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def register(self, collector):
+        self.collectors.append(collector)
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.duration_buckets), 0.0, 0]
+            for index, bound in enumerate(self.duration_buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, []).append((name, labels, value))
+            for (name, labels), (buckets, total, count) in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, bucket_count in zip(self.duration_buckets, buckets):
+                    lines.append((name + "_bucket", labels + (("le", str(bound)),), bucket_count))
+                lines.append((name + "_bucket", labels + (("le", "+Inf"),), count))
+                lines.append((name + "_sum", labels, total))
+                lines.append((name + "_count", labels, count))
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append((name, label_key(labels), value))
+
+        output = []
+        for name, lines in sorted(samples.items()):
+            metric_type, description = self.descriptions.get(name, ("untyped", name))
+            output.append("# HELP %s %s" % (name, description))
+            output.append("# TYPE %s %s" % (name, metric_type))
+            for sample_name, labels, value in lines:
+                label_text = ",".join('%s="%s"' % (key, str(label).replace('"', '\\"')) for key, label in labels)
+                output.append("%s{%s} %s" % (sample_name, label_text, value) if label_text
+                              else "%s %s" % (sample_name, value))
+        return "\n".join(output) + "\n"
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+# Turns an API url into a low cardinality label, e.g. "/setup/devices/states" or "/events/fetch"
+def endpoint_label(config, url):
+    path = api_path(config, url)
+    if path.startswith("/setup/devices/"):
+        return "/setup/devices/states"
+    if path.startswith("/events/") and path != "/events/register":
+        return "/events/fetch"
+    if path.startswith("/exec/current/"):
+        return "/exec/current"
+    return path
+
+
+def api_path(config, url):
+    for api_url in [config.api_url] + [raw["url"] for raw in config.local_gateways.values()]:
+        if url.startswith(api_url):
+            return url[len(api_url):]
+    return urlparse(url).path
+
+
+def start_metrics_server(config):
+    if config.metrics_port is None:
+        return
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Metrics request: " + format, *args)
+
+    server = ThreadingHTTPServer((config.metrics_host, config.metrics_port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="aasivak-metrics", daemon=True).start()
+    logging.info("Serving metrics on http://%s:%s/metrics", config.metrics_host, config.metrics_port)
+
+
+metrics = Metrics()
+
+
+# Time spent in each phase of one refresh cycle: waiting for the API responses (fetch), parsing them (parse), applying
+# them to the devices (update) and publishing the states (publish). Cycles slower than slow_cycle_threshold are logged
+# with their breakdown.
+class CycleTrace:
+    phases = ["fetch", "parse", "update", "publish"]
+
+    def __init__(self):
+        self.started = time.time()
+        self.seconds = dict.fromkeys(self.phases, 0.0)
+        self.api_calls = 0
+
+    def measure(self, phase, function, *args):
+        started = time.time()
+        result = function(*args)
+        self.seconds[phase] += time.time() - started
+        return result
+
+    # Splits the time of an adapter fetch method between the API requests and the rest, which is mostly parsing
+    def fetch(self, hikumo, function, *args):
+        started = time.time()
+        request_seconds = hikumo.request_seconds
+        result = function(*args)
+        self.add_fetch(hikumo, started, request_seconds)
+        return result
+
+    async def fetch_async(self, hikumo, function, *args):
+        started = time.time()
+        request_seconds = hikumo.request_seconds
+        result = await function(*args)
+        self.add_fetch(hikumo, started, request_seconds)
+        return result
+
+    def add_fetch(self, hikumo, started, request_seconds):
+        # Concurrent commands count as fetch time too
+        fetch_seconds = hikumo.request_seconds - request_seconds
+        self.seconds["fetch"] += fetch_seconds
+        self.seconds["parse"] += max(0.0, time.time() - started - fetch_seconds)
+        self.api_calls += 1
+
+    def finish(self, config):
+        duration = time.time() - self.started
+        metrics.observe("aasivak_refresh_duration_seconds", duration)
+        for phase in self.phases:
+            metrics.observe("aasivak_refresh_phase_seconds", self.seconds[phase], {"phase": phase})
+        if config.slow_cycle_threshold and duration >= config.slow_cycle_threshold:
+            logging.warning("Slow refresh cycle: %.2fs, %s in %d API call(s)", duration,
+                            ", ".join("%s %.2fs" % (phase, self.seconds[phase]) for phase in self.phases),
+                            self.api_calls)
+
+
+# Statistical profiler of all the threads, started with a message on mqtt_profile_topic while the bridge runs. It
+# samples the stacks of the threads every profile_interval seconds for the number of seconds in the message (or
+# profile_duration), then writes the functions seen most often in each thread to a report in profile_dir.
+class SamplingProfiler:
+    report_size = 25
+
+    def __init__(self):
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self, config, payload):
+        try:
+            duration = min(3600, float(payload.decode("utf-8") or config.profile_duration))
+        except ValueError:
+            duration = config.profile_duration
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                logging.warning("A profiling session is already running")
+                return
+            self.thread = threading.Thread(target=self.run, args=(config, duration), name="aasivak-profiler",
+                                           daemon=True)
+            self.thread.start()
+        logging.info("Profiling for %ss", duration)
+
+    def run(self, config, duration):
+        own_id = threading.get_ident()
+        running = {}  # (thread name, function) -> samples where the function was running
+        on_stack = {}  # (thread name, function) -> samples where the function was on the stack
+        samples = 0
+        started = time.time()
+        while time.time() - started < duration:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                name = names.get(thread_id, str(thread_id))
+                seen = set()
+                key = None
+                while frame is not None:
+                    code = frame.f_code
+                    function = (name, "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                                                      code.co_firstlineno))
+                    if key is None:
+                        key = function
+                        running[key] = running.get(key, 0) + 1
+                    if function not in seen:
+                        seen.add(function)
+                        on_stack[function] = on_stack.get(function, 0) + 1
+                    frame = frame.f_back
+            samples += 1
+            time.sleep(config.profile_interval)
+        self.write_report(config, time.time() - started, samples, running, on_stack)
+
+    def write_report(self, config, duration, samples, running, on_stack):
+        lines = ["Aasivak profile of %s: %.1fs, %d samples every %ss" % (
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() - duration)), duration, samples,
+            config.profile_interval)]
+        for thread_name in sorted({name for name, function in on_stack}):
+            lines += ["", "Thread %s" % thread_name, "%8s %8s  %s" % ("self %", "total %", "function")]
+            functions = [(count, function) for (name, function), count in on_stack.items() if name == thread_name]
+            for count, function in sorted(functions, reverse=True)[:self.report_size]:
+                lines.append("%8.1f %8.1f  %s" % (100.0 * running.get((thread_name, function), 0) / samples,
+                                                  100.0 * count / samples, function))
+        file_name = os.path.join(config.profile_dir, time.strftime("profile-%Y%m%d-%H%M%S.txt"))
+        try:
+            os.makedirs(config.profile_dir, exist_ok=True)
+            with open(file_name, 'w', encoding="utf-8") as report_file:
+                report_file.write("\n".join(lines) + "\n")
+        except IOError as e:
+            logging.warning("Could not write the profile report: %s", e)
+            return
+        logging.info("Profile report written to %s", file_name)
+
+
+profiler = SamplingProfiler()
+
+
+################
+
+# Records the Hi-Kumo API responses and the MQTT messages received into record_file, as gzipped json lines with the
+# number of seconds since the start. A response body is only written when it differs from the previous one of the
+# same API path.
+class Recorder:
+    def __init__(self, config):
+        self.config = config
+        self.file = gzip.open(config.record_file, "wt", encoding="utf-8")
+        self.started = time.time()
+        self.last_flush = self.started
+        self.body_hashes = {}
+        self.lock = threading.Lock()
+        logging.info("Recording the Hi-Kumo API responses and the MQTT messages to %s", config.record_file)
+
+    def api(self, method, url, response):
+        key = method + " " + api_path(self.config, url)
+        record = {"api": key, "status": None if response is None else response.status_code}
+        with self.lock:
+            if response is not None:
+                body_hash = hash(response.text)
+                if self.body_hashes.get(key, None) != body_hash:
+                    self.body_hashes[key] = body_hash
+                    record["body"] = response.text
+            self.write(record)
+
+    def message(self, message):
+        with self.lock:
+            self.write({"mqtt": message.topic, "payload": message.payload.decode("utf-8")})
+
+    def write(self, record):
+        now = time.time()
+        record["t"] = round(now - self.started, 3)
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        if now - self.last_flush >= 1:
+            self.last_flush = now
+            self.file.flush()
+
+
+# Stands in for the Hi-Kumo API and the MQTT broker with the content of replay_file, replay_speed times faster than it
+# was recorded. The API calls get the last response recorded for their path (or their endpoint, when the ids differ)
+# at the current replay time.
+class Replayer:
+    def __init__(self, config):
+        self.config = config
+        self.responses = {}  # api key -> ([record times], [(status code, body)])
+        self.endpoint_responses = {}
+        self.messages = []
+        self.duration = 0
+        self.stats = {"api": 0, "missing": 0, "mqtt": 0}
+        bodies = {}
+        with gzip.open(config.replay_file, "rt", encoding="utf-8") as replay_file:
+            try:
+                for line in replay_file:
+                    record = json.loads(line)
+                    self.duration = record["t"]
+                    if "mqtt" in record:
+                        self.messages.append((record["t"], record["mqtt"], record["payload"]))
+                        continue
+                    key = record["api"]
+                    body = bodies[key] = record.get("body", bodies.get(key, None))
+                    method, path = key.split(" ", 1)
+                    endpoint_key = method + " " + endpoint_label(config, config.api_url + path)
+                    for index, response_key in ((self.responses, key), (self.endpoint_responses, endpoint_key)):
+                        times, responses = index.setdefault(response_key, ([], []))
+                        times.append(record["t"])
+                        responses.append((record["status"], body))
+            except (EOFError, ValueError) as e:
+                # The end of a recording that was not closed properly
+                logging.warning("Replay file truncated: %s", e)
+        self.started = time.time()
+        logging.info("Replaying %.0fs of Hi-Kumo API responses and %d MQTT messages from %s at %sx", self.duration,
+                     len(self.messages), config.replay_file, config.replay_speed)
+
+    def clock(self):
+        return (time.time() - self.started) * self.config.replay_speed
+
+    def is_finished(self):
+        return self.clock() > self.duration
+
+    def response(self, method, url, headers=None):
+        self.stats["api"] += 1
+        key = method + " " + api_path(self.config, url)
+        times, responses = self.responses.get(key, None) or self.endpoint_responses.get(
+            method + " " + endpoint_label(self.config, url), ([], []))
+        if not times:
+            self.stats["missing"] += 1
+            return ApiResponse(404, '{"error": "Not recorded"}')
+        index = max(0, bisect.bisect_right(times, self.clock()) - 1)
+        status, body = responses[index]
+        if status == 304 and not is_conditional(headers):
+            # The replayed bridge did not ask for a 304: it gets the last setup recorded in full instead
+            status, body = next((response for response in reversed(responses[:index]) if response[0] == 200),
+                                (status, body))
+        if status is None:
+            raise IOError("Recorded connection error")
+        return ApiResponse(status, body)
+
+    # Delivers the recorded MQTT messages at their replay time, from a thread of its own
+    def deliver_messages(self, deliver):
+        for moment, topic, payload in self.messages:
+            delay = self.started + moment / self.config.replay_speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            message = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+            message.payload = payload.encode("utf-8")
+            self.stats["mqtt"] += 1
+            deliver(message)
+
+    def log_stats(self):
+        logging.info("Replay finished in %.1fs: %d API calls (%d not recorded), %d MQTT messages",
+                     time.time() - self.started, self.stats["api"], self.stats["missing"], self.stats["mqtt"])
+
+
+# Replays run without any broker
+def connect_mqtt(config, mqtt_client):
+    if not config.replay_file:
+        mqtt_client.connect(config.mqtt_host, config.mqtt_port)
+
+
+# The messages published before the disconnection are sent first
+def disconnect_mqtt(mqtt_client):
+    mqtt_client.disconnect()
+    mqtt_client.loop_stop()
+
+
+################
+
+class House:
+    def __init__(self, config=None, mqtt_client=None, http_adapter=None, scheduler=None, routes=None):
+        # The MQTT client, HTTP connection pool, command scheduler and routes are shared when the house is part of a
+        # HouseGroup
+        self.config = config or self.read_config()
+        self.config.check_account()
+        if self.is_asyncio():
+            AsyncHikumoAdapter.check_config(self.config)
+        self.owns_mqtt_client = mqtt_client is None
+        if self.owns_mqtt_client:
+            logging.basicConfig(level=self.config.logging_level,
+                                format="%(asctime)-15s %(levelname)-8s %(message)s")
+            mqtt_client = create_mqtt_client(self.config)
+            start_metrics_server(self.config)
+            if not self.is_asyncio():
+                connect_mqtt(self.config, mqtt_client)
+        self.mqtt_client = mqtt_client
+        for key in self.config.unused_keys:
+            logging.warning("'%s' has no effect with state_refresh: %s, only with state_refresh: devices", key,
+                            self.config.state_refresh)
+        self.gateways = {}
+        self.devices = {}
+        self.devices_by_url = {}
+        self.routes = {} if routes is None else routes  # command topic -> (device, attribute, payload parser)
+        self.subscribed_topics = set()
+        self.mqtt_loop_started = False
+        self.reset_requested = False
+        self.wakeup = threading.Event()
+        self.listener_id = None
+        self.listener_lost = False  # whether changes may have been missed since the last setup, without a listener
+        self.last_setup_check = 0
+        self.setup_up_to_date = False  # whether every device took its states from the last setup fetched
+        self.executions = {}  # execution id -> (devices, time sent)
+        # Final states of the executions whose event came before exec/apply returned: execution id -> (state, time)
+        self.finished_executions = {}
+        self.executions_lock = threading.Lock()
+        self.next_gateway_refresh = 0
+        self.budget = RequestBudget(self.config.api_budget)
+        self.publish_stats = {"sent": 0, "suppressed": 0}
+        self.last_stats_log = time.time()
+        self.last_snapshot = 0
+        self.delayer = Delayer(self.config.refresh_delays, self.config.refresh_delay_randomness)
+        self.recorder = Recorder(self.config) if self.config.record_file else None
+        self.replayer = Replayer(self.config) if self.config.replay_file else None
+        self.journal = CommandJournal(self.config)
+        metrics.register(self.collect_metrics)
+        if self.is_asyncio():
+            # The asyncio adapter and scheduler must be created from within the running event loop
+            self.hikumo = None
+            self.scheduler = scheduler
+        else:
+            self.hikumo = HikumoAdapter(self.config, http_adapter, self.recorder, self.replayer)
+            self.scheduler = scheduler or CommandScheduler(self.config)
+
+    def is_asyncio(self):
+        return self.config.event_loop == "asyncio"
+
+    @staticmethod
+    def read_config(config_files=None):
+        return Config(House.read_raw_config(config_files))
+
+    # Without config files, reads config/default.yml then config/local.yml if it exists, from the current directory.
+    # The keys of each file override the ones of the files before it.
+    @staticmethod
+    def read_raw_config(config_files=None):
+        import yaml
+
+        optional_files = []
+        if not config_files:
+            config_files = ["config/default.yml", "config/local.yml"]
+            optional_files = ["config/local.yml"]
+        raw_config = {}
+        for config_file in config_files:
+            try:
+                with open(config_file, 'r', encoding="utf-8") as yml_file:
+                    raw_config.update(yaml.safe_load(yml_file) or {})
+            except IOError:
+                if config_file not in optional_files:
+                    raise
+                logging.info("No local config file found")
+
+        return raw_config
+
+    def register_all(self):
+        self.start_mqtt()
+        self.subscribe_all()
+        self.publish_discovery_all()
+
+    def publish_discovery_all(self):
+        for index, batch in enumerate(self.discovery_batches()):
+            if index:
+                time.sleep(self.config.mqtt_discovery_batch_delay)
+            for device, messages in batch:
+                device.publish_discovery(messages)
+
+    async def register_all_async(self):
+        import asyncio
+
+        self.start_mqtt()
+        self.subscribe_all()
+        for index, batch in enumerate(self.discovery_batches()):
+            if index:
+                await asyncio.sleep(self.config.mqtt_discovery_batch_delay)
+            for device, messages in batch:
+                device.publish_discovery(messages)
+
+    def start_mqtt(self):
+        if not self.owns_mqtt_client:
+            return
+        self.mqtt_client.on_message = self.on_message
+        self.mqtt_client.on_connect = self.on_connect
+        if not self.is_asyncio() and not self.mqtt_loop_started and not self.config.replay_file:
+            self.mqtt_client.loop_start()
+            self.mqtt_loop_started = True
+
+    def on_connect(self, client, userdata, flags, rc):
+        # Subscriptions are lost when the broker does not keep the session
+        self.subscribed_topics.clear()
+        self.subscribe_all()
+
+    # Subscribes to all the topics not subscribed yet, in one single SUBSCRIBE packet
+    def subscribe_all(self):
+        if self.config.mqtt_wildcard_subscribe:
+            topics = [self.config.mqtt_command_prefix + "/+/+"]
+        else:
+            topics = [topic for device in self.devices.values() for topic in device.command_topics]
+        topics += [self.config.mqtt_reset_topic, self.config.mqtt_profile_topic]
+        new_topics = [(topic, 0) for topic in topics if topic not in self.subscribed_topics]
+        if new_topics:
+            self.mqtt_client.subscribe(new_topics)
+            self.subscribed_topics.update(topic for topic, qos in new_topics)
+
+    # Discovery messages are sent in batches of mqtt_discovery_batch_size. When they are retained by the broker, only
+    # the ones that changed since they were last sent are sent again.
+    def discovery_batches(self):
+        if not self.config.mqtt_discovery:
+            return []
+        pending = []
+        for device in self.devices.values():
+            messages = device.discovery_messages()
+            if self.config.mqtt_config_retain and device.discovery_hash == hash(tuple(messages)):
+                continue
+            pending.append((device, messages))
+        size = max(1, self.config.mqtt_discovery_batch_size)
+        return [pending[index:index + size] for index in range(0, len(pending), size)]
+
+    def unregister_all(self):
+        self.mqtt_client.on_message = None
+        self.mqtt_client.unsubscribe(list(self.subscribed_topics))
+        self.subscribed_topics.clear()
+        for device_id, device in self.devices.items():
+            device.unregister_mqtt()
+        if self.mqtt_loop_started:
+            self.mqtt_client.loop_stop()
+            self.mqtt_loop_started = False
+
+    def is_available(self, url):
+        gateway_id = urlparse(url).netloc
+        raw_gateway = self.gateways[gateway_id]
+        if raw_gateway is not None:
+            return bool(raw_gateway["alive"])
+        else:
+            return False
+
+    def update_all_devices(self, trace=None):
+        trace = trace or CycleTrace()
+        raw_data = trace.fetch(self.hikumo, self.hikumo.fetch_api_setup_data, self.is_setup_conditional())
+        trace.measure("update", self.apply_setup_data, raw_data)
+
+    # An unchanged setup can only be skipped when the devices took their states from the previous one, and no command
+    # was received since. The consistency checks of the events sync mode and of the "devices" refresh mode always get
+    # the full setup, only the plain setup polls are conditional.
+    def is_setup_conditional(self):
+        return (self.setup_up_to_date and self.last_setup_check != 0 and self.config.sync_mode != "events"
+                and self.config.state_refresh != "devices")
+
+    # raw_data is None when the setup did not change since the last one applied
+    def apply_setup_data(self, raw_data):
+        if raw_data is None:
+            self.last_setup_check = time.time()
+            for device in self.devices.values():
+                device.last_update = self.last_setup_check
+                self.schedule_refresh(device)
+        elif "gateways" in raw_data and "devices" in raw_data:
+            self.last_setup_check = time.time()
+            self.setup_up_to_date = True
+            self.apply_gateways(raw_data["gateways"])
+            for raw_device in raw_data["devices"]:
+                if raw_device["type"] == 1:
+                    device_id = raw_device["oid"]
+                    name = raw_device["label"]
+                    url = raw_device["deviceURL"]
+                    available = self.is_available(url)
+                    if device_id in self.devices:
+                        device = self.devices[device_id]
+                    else:
+                        device = Device(self, device_id, name, url)
+                        self.devices[device.id] = device
+                        self.devices_by_url[url] = device
+                    device.update_definitions(raw_device["definition"]["states"])
+                    if device.state_dirty or device.pending_execution is not None:
+                        self.setup_up_to_date = False
+                    device.update_states(raw_device["states"], available)
+                    self.schedule_refresh(device)
+
+    def apply_events(self, events):
+        changed_devices = set()
+        for event in events:
+            event_name = event.get("name", None)
+            if event_name == "DeviceStateChangedEvent":
+                device = self.devices_by_url.get(event["deviceURL"], None)
+                if device is not None:
+                    device.update_states_delta(event["deviceStates"])
+                    changed_devices.add(device)
+            elif event_name in ("GatewayAliveEvent", "GatewayDownEvent"):
+                gateway_id = event["gatewayId"]
+                if gateway_id in self.gateways:
+                    self.gateways[gateway_id]["alive"] = event_name == "GatewayAliveEvent"
+                for device in self.devices.values():
+                    if urlparse(device.command_url).netloc == gateway_id:
+                        device.update_availability(self.is_available(device.command_url))
+                        changed_devices.add(device)
+            elif event_name == "ExecutionStateChangedEvent":
+                exec_id = event.get("execId", None)
+                new_state = event.get("newState", None)
+                logging.debug("Execution %s is %s", exec_id, new_state)
+                if new_state == "FAILED":
+                    # The devices did not reach the commanded state: run a consistency check on the next cycle
+                    logging.warning("Execution %s failed", exec_id)
+                    self.last_setup_check = 0
+                if new_state in ("COMPLETED", "FAILED"):
+                    with self.executions_lock:
+                        if exec_id in self.executions:
+                            self.finish_execution(exec_id, new_state)
+                        else:
+                            self.keep_finished_execution(exec_id, new_state)
+        for device in changed_devices:
+            device.publish_state()
+        if changed_devices:
+            self.save_snapshot()
+
+    # Called by the command scheduler with the exec/apply response of the commands sent for the devices
+    def on_actions_applied(self, devices, response, transport=None):
+        exec_id = execution_id(response)
+        if exec_id is None and classify_response(response) in ("transient", "auth"):
+            self.defer_commands(devices)
+            return
+        self.journal.acknowledge(devices)
+        if exec_id is None:
+            logging.warning("Hi-Kumo did not accept the commands for %d device(s), status code %s",
+                            len(devices), status_code(response))
+            metrics.inc("aasivak_executions_total", {"account": self.config.name, "state": "rejected"})
+            for device in devices:
+                if device.pending_execution == "":
+                    device.pending_execution = None
+                device.rollback()
+            self.last_setup_check = 0
+            return
+        with self.executions_lock:
+            self.executions[exec_id] = (devices, time.time(), transport)
+            for device in devices:
+                if device.pending_execution == "":
+                    device.pending_execution = exec_id
+            finished = self.finished_executions.pop(exec_id, None)
+            if finished is not None:
+                self.finish_execution(exec_id, finished[0])
+
+    # The commands that did not reach Hi-Kumo stay dirty, so that the refreshes do not overwrite them, and are sent
+    # again after a backoff. The refresh loop is woken up to wait for the retry rather than for the next refresh.
+    def defer_commands(self, devices):
+        delay = self.journal.defer(devices)
+        logging.warning("Hi-Kumo could not be reached, sending the commands for %d device(s) again in %.1fs",
+                        len(devices), delay)
+        metrics.inc("aasivak_executions_total", {"account": self.config.name, "state": "deferred"})
+        for device in devices:
+            if device.pending_execution == "":
+                device.pending_execution = None
+            device.state_dirty = True
+        if self.is_asyncio():
+            import asyncio
+
+            asyncio.get_running_loop().call_later(delay, self.retry_commands)
+        else:
+            self.wakeup.set()
+
+    def retry_commands(self):
+        for device in self.journal.due_retries():
+            if self.journal.has_commands(device):
+                self.scheduler.submit(device)
+                continue
+            # The state from before the commands is published again, and checked on the next cycle
+            logging.warning("Dropping the commands for device '%s', older than %ss", device.name,
+                            self.config.command_max_age)
+            metrics.inc("aasivak_executions_total", {"account": self.config.name, "state": "expired"})
+            device.state_dirty = False
+            device.rollback()
+            self.last_setup_check = 0
+
+    # The commands of the journal that did not reach Hi-Kumo before the last restart are sent again
+    def resume_commands(self):
+        if self.journal.resumed:
+            return
+        self.journal.resumed = True
+        for device_id, commands in self.journal.pending_commands().items():
+            device = self.devices.get(device_id, None)
+            if device is None:
+                continue
+            logging.info("Resuming %d command(s) for device '%s'", len(commands), device.name)
+            for attr, value in commands.items():
+                device.on_command(attr, value)
+            if self.config.optimistic_state:
+                device.publish_state()
+
+    def with_retry_delay(self, delay):
+        retry_delay = self.journal.retry_delay()
+        return delay if retry_delay is None else min(delay, retry_delay)
+
+    # Runs what is due between two refresh cycles: the reset requested on MQTT and the commands to send again
+    def run_pending(self):
+        if self.reset_requested:
+            self.reset()
+        self.retry_commands()
+
+    # The events are fetched while the commands are sent: the final state of an execution may come before its id. It is
+    # kept until then, or until execution_timeout for the executions of other Hi-Kumo clients.
+    def keep_finished_execution(self, exec_id, state):
+        now = time.time()
+        for old_exec_id, (old_state, received) in list(self.finished_executions.items()):
+            if now - received >= self.config.execution_timeout:
+                del self.finished_executions[old_exec_id]
+        self.finished_executions[exec_id] = (state, now)
+
+    # Stops waiting for an execution. The commanded state was published optimistically: it is rolled back when the
+    # execution failed, and left for the next refresh to confirm otherwise.
+    def finish_execution(self, exec_id, state):
+        execution = self.executions.pop(exec_id, None)
+        if execution is None:
+            return
+        devices, sent, transport = execution
+        logging.debug("Execution %s finished as %s after %.1fs", exec_id, state, time.time() - sent)
+        self.setup_up_to_date = False
+        metrics.inc("aasivak_executions_total", {"account": self.config.name, "state": state.lower()})
+        for device in devices:
+            if device.pending_execution == exec_id:
+                device.pending_execution = None
+            if state == "FAILED":
+                device.rollback()
+            elif device.pending_execution is None and not device.state_dirty:
+                device.rollback_state = None
+        if state in ("FAILED", "TIMEOUT"):
+            self.last_setup_check = 0
+            self.delayer.reset()
+
+    # Without an event listener, the executions are polled until they are no longer running. The executions sent to a
+    # local API are always polled, the cloud event listener does not report them.
+    def track_executions(self):
+        for exec_id, (devices, sent, transport) in list(self.executions.items()):
+            if time.time() - sent >= self.config.execution_timeout:
+                self.finish_execution(exec_id, "TIMEOUT")
+            elif self.is_execution_polled(transport) and self.hikumo.is_execution_running(exec_id, transport) is False:
+                self.finish_execution(exec_id, "FINISHED")
+
+    async def track_executions_async(self):
+        for exec_id, (devices, sent, transport) in list(self.executions.items()):
+            if time.time() - sent >= self.config.execution_timeout:
+                self.finish_execution(exec_id, "TIMEOUT")
+            elif (self.is_execution_polled(transport)
+                  and await self.hikumo.is_execution_running(exec_id, transport) is False):
+                self.finish_execution(exec_id, "FINISHED")
+
+    def is_execution_polled(self, transport):
+        return self.config.sync_mode != "events" or (transport is not None and transport.local)
+
+    def sync_events(self):
+        if self.listener_id is None:
+            if not self.on_listener_registered(self.hikumo.register_event_listener()):
+                return self.delayer.next()
+
+        if self.is_setup_check_due():
+            self.refresh_all()
+            self.last_setup_check = time.time()
+
+        return self.on_events_fetched(self.hikumo.fetch_events(self.listener_id))
+
+    async def sync_events_async(self):
+        if self.listener_id is None:
+            if not self.on_listener_registered(await self.hikumo.register_event_listener()):
+                return self.delayer.next()
+
+        if self.is_setup_check_due():
+            await self.refresh_all_async()
+            self.last_setup_check = time.time()
+
+        return self.on_events_fetched(await self.hikumo.fetch_events(self.listener_id))
+
+    def on_listener_registered(self, listener_id):
+        self.listener_id = listener_id
+        if listener_id is None:
+            self.listener_lost = True
+            return False
+        # Changes may have been missed while there was no listener. The first one follows the setup fetched at start.
+        if self.listener_lost:
+            self.listener_lost = False
+            self.last_setup_check = 0
+        return True
+
+    def is_setup_check_due(self):
+        return time.time() - self.last_setup_check >= self.config.setup_check_delay
+
+    def on_events_fetched(self, events):
+        if events is None:
+            logging.info("Hi-Kumo event listener %s expired", self.listener_id)
+            self.listener_id = None
+            self.listener_lost = True
+            return self.delayer.next()
+        self.delayer.reset()
+        self.apply_events(events)
+        return self.config.event_fetch_delay
+
+    # Runs one synchronisation cycle and returns how long to wait before the next one
+    def step(self):
+        if self.reset_requested:
+            self.reset()
+        self.hikumo.renew_session()
+        self.track_executions()
+        self.retry_commands()
+        if self.config.sync_mode == "events":
+            return self.with_retry_delay(self.sync_events())
+        self.refresh_all()
+        return self.with_retry_delay(self.next_refresh_delay())
+
+    async def step_async(self):
+        await self.hikumo.renew_session()
+        await self.track_executions_async()
+        self.retry_commands()
+        if self.config.sync_mode == "events":
+            return self.with_retry_delay(await self.sync_events_async())
+        await self.refresh_all_async()
+        return self.with_retry_delay(self.next_refresh_delay())
+
+    def refresh_all(self):
+        trace = CycleTrace()
+        if self.is_state_refresh():
+            refresh_gateways, devices = self.due_refreshes()
+            if refresh_gateways:
+                trace.measure("update", self.apply_gateways, trace.fetch(self.hikumo, self.hikumo.fetch_gateways))
+            for device in devices:
+                raw_states = trace.fetch(self.hikumo, self.hikumo.fetch_device_states, device.command_url)
+                trace.measure("update", self.apply_device_states, device, raw_states)
+        else:
+            self.update_all_devices(trace)
+        trace.measure("publish", self.publish_all)
+        trace.finish(self.config)
+
+    async def refresh_all_async(self):
+        trace = CycleTrace()
+        if self.is_state_refresh():
+            refresh_gateways, devices = self.due_refreshes()
+            if refresh_gateways:
+                raw_gateways = await trace.fetch_async(self.hikumo, self.hikumo.fetch_gateways)
+                trace.measure("update", self.apply_gateways, raw_gateways)
+            for device in devices:
+                raw_states = await trace.fetch_async(self.hikumo, self.hikumo.fetch_device_states, device.command_url)
+                trace.measure("update", self.apply_device_states, device, raw_states)
+        else:
+            raw_data = await trace.fetch_async(self.hikumo, self.hikumo.fetch_api_setup_data,
+                                               self.is_setup_conditional())
+            trace.measure("update", self.apply_setup_data, raw_data)
+        trace.measure("publish", self.publish_all)
+        trace.finish(self.config)
+
+    # In the "devices" refresh mode, only the states of the known devices are fetched, and the whole setup only every
+    # setup_check_delay seconds
+    def is_state_refresh(self):
+        if self.config.state_refresh != "devices" or not self.devices:
+            return False
+        return not self.is_setup_check_due()
+
+    def apply_gateways(self, raw_gateways):
+        for raw_gateway in raw_gateways or []:
+            self.gateways[raw_gateway["gatewayId"]] = raw_gateway
+        # Gateways are checked more often while one is down, so that its devices come back quickly
+        all_alive = all(raw_gateway["alive"] for raw_gateway in self.gateways.values())
+        self.next_gateway_refresh = time.time() + (max if all_alive else min)(self.config.refresh_delays)
+
+    def apply_device_states(self, device, raw_states):
+        if raw_states is not None:
+            device.update_states(raw_states, self.is_available(device.command_url))
+        self.schedule_refresh(device)
+
+    # In the "devices" refresh mode, each device has its own refresh cadence. It slows down over refresh_delays after
+    # a command like the global one, stays at the current step while the room temperature moves, and is
+    # idle_refresh_delay for units that are off or behind a gateway that is down.
+    def schedule_refresh(self, device):
+        if device.power_state == "off" or not self.is_available(device.command_url):
+            delay = self.config.idle_refresh_delay
+        else:
+            if device.refresh_temperature is not None and device.temperature != device.refresh_temperature:
+                device.refresh_delayer.speed_up()
+            delay = device.refresh_delayer.next()
+        device.refresh_temperature = device.temperature
+        device.next_refresh = time.time() + delay
+
+    # The gateways and devices due for a refresh, most overdue first, within the API budget. The devices waiting for
+    # their command to run are left for later.
+    def due_refreshes(self):
+        now = time.time()
+        refresh_gateways = now >= self.next_gateway_refresh and self.budget.acquire()
+        devices = []
+        for device in sorted(self.devices.values(), key=lambda device: device.next_refresh):
+            if device.next_refresh > now:
+                break
+            if device.state_dirty or device.pending_execution is not None:
+                continue
+            if not self.budget.acquire():
+                metrics.inc("aasivak_refresh_deferred_total", {"account": self.config.name})
+                break
+            devices.append(device)
+        return refresh_gateways, devices
+
+    def next_refresh_delay(self):
+        if self.config.state_refresh != "devices" or not self.devices:
+            return self.delayer.next()
+        now = time.time()
+        next_refresh = min([device.next_refresh for device in self.devices.values()
+                            if not device.state_dirty and device.pending_execution is None]
+                           + [self.next_gateway_refresh, self.last_setup_check + self.config.setup_check_delay])
+        delay = max(next_refresh - now, self.budget.wait_time())
+        if self.executions:
+            # The running executions are polled on each cycle
+            delay = min(delay, min(self.config.refresh_delays))
+        # Commands make devices due earlier without waking the loop up
+        return max(0, min(delay, max(self.config.refresh_delays)))
+
+    def publish_all(self):
+        for device in self.devices.values():
+            device.publish_state()
+        self.log_stats()
+        self.save_snapshot()
+
+    # Registers and publishes the devices of the last snapshot right away, before the first (possibly slow) login and
+    # setup fetch. They are published as stale, with the time of their state, until the live state comes in.
+    def warm_start(self):
+        if not self.load_snapshot():
+            return False
+        self.configure_devices()
+        self.register_all()
+        self.publish_all()
+        return True
+
+    async def warm_start_async(self):
+        if not self.load_snapshot():
+            return False
+        self.configure_devices()
+        await self.register_all_async()
+        self.publish_all()
+        return True
+
+    def load_snapshot(self):
+        if not self.config.snapshot_file:
+            return False
+        # Read completely before anything is changed: an incomplete or outdated snapshot falls back to a cold start
+        try:
+            with open(self.config.snapshot_file, 'r', encoding="utf-8") as snapshot_file:
+                raw_snapshot = json.load(snapshot_file)
+            gateways = dict(raw_snapshot["gateways"])
+            devices = [Device.from_snapshot(self, raw_device) for raw_device in raw_snapshot["devices"]]
+            snapshot_time = time.ctime(raw_snapshot["time"])
+        except (IOError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.info("No usable snapshot: %r", e)
+            return False
+
+        self.last_snapshot = time.time()
+        self.gateways.update(gateways)
+        for device in devices:
+            self.devices[device.id] = device
+            self.devices_by_url[device.command_url] = device
+        logging.info("Loaded %d device(s) from the snapshot of %s", len(devices), snapshot_time)
+        return True
+
+    def save_snapshot(self):
+        if not self.config.snapshot_file or time.time() - self.last_snapshot < self.config.snapshot_delay:
+            return
+        self.last_snapshot = time.time()
+        raw_snapshot = {
+            "time": self.last_snapshot,
+            "gateways": self.gateways,
+            "devices": [device.to_snapshot() for device in self.devices.values()]
+        }
+        temp_file_name = self.config.snapshot_file + ".tmp"
+        try:
+            with open(temp_file_name, 'w', encoding="utf-8") as snapshot_file:
+                json.dump(raw_snapshot, snapshot_file, separators=(",", ":"))
+            os.replace(temp_file_name, self.config.snapshot_file)
+        except IOError as e:
+            logging.warning("Could not save the snapshot: %s", e)
+
+    def collect_metrics(self):
+        labels = {"account": self.config.name}
+        samples = [
+            ("aasivak_mqtt_messages_published_total", labels, self.publish_stats["sent"]),
+            ("aasivak_mqtt_messages_suppressed_total", labels, self.publish_stats["suppressed"])
+        ]
+        if self.hikumo is not None:
+            samples += [
+                ("aasivak_api_retries_total", labels, self.hikumo.stats["retries"]),
+                ("aasivak_api_logins_total", labels, self.hikumo.stats["logins"]),
+                ("aasivak_api_rejected_total", labels, self.hikumo.stats["rejected"]),
+                ("aasivak_circuit_breaker_open", labels, int(self.hikumo.breaker.state != "closed")),
+                ("aasivak_circuit_breaker_trips_total", labels, self.hikumo.breaker.trips)
+            ]
+        now = time.time()
+        for device in list(self.devices.values()):
+            samples.append(("aasivak_device_staleness_seconds", {"account": self.config.name, "device": device.id},
+                            now - device.last_update if device.last_update else -1))
+        return samples
+
+    def log_stats(self):
+        if time.time() - self.last_stats_log >= self.config.publish_heartbeat:
+            self.last_stats_log = time.time()
+            logging.info("MQTT state messages: %d sent, %d suppressed",
+                         self.publish_stats["sent"], self.publish_stats["suppressed"])
+            logging.info("Hi-Kumo API: %d retries, %d logins, %d calls rejected, circuit breaker %s (%d trips)",
+                         self.hikumo.stats["retries"], self.hikumo.stats["logins"], self.hikumo.stats["rejected"],
+                         self.hikumo.breaker.state, self.hikumo.breaker.trips)
+
+    def setup(self):
+        self.update_all_devices()
+        self.configure_devices()
+        self.resume_commands()
+
+    def start_async(self, connector=None):
+        self.hikumo = AsyncHikumoAdapter(self.config, connector, self.recorder, self.replayer)
+        if self.scheduler is None:
+            self.scheduler = AsyncCommandScheduler(self.config)
+
+    async def setup_async(self):
+        self.apply_setup_data(await self.hikumo.fetch_api_setup_data())
+        self.configure_devices()
+        self.resume_commands()
+
+    def configure_devices(self):
+        for topic in [topic for topic, route in self.routes.items() if route[0].house is self]:
+            del self.routes[topic]
+        for device in self.devices.values():
+            device.update_mqtt_config()
+            for topic, (attr, parser) in device.command_topics.items():
+                self.routes[topic] = (device, attr, parser)
+            # device.publish_state()
+            logging.info("Device found: %s (%s|%s)", device.name, device.id, device.command_url)
+
+    # Resets are requested from the MQTT callback but run in the refresh loop, so that the MQTT network loop is never
+    # blocked by the setup fetch and the paced discovery messages
+    def request_reset(self):
+        if self.is_asyncio():
+            import asyncio
+
+            asyncio.ensure_future(self.reset_async())
+        else:
+            self.reset_requested = True
+            self.wakeup.set()
+
+    def reset(self):
+        self.reset_requested = False
+        for device in self.devices.values():
+            device.reset_published()
+            device.invalidate_cache()
+        self.setup()
+        self.register_all()
+        # The states cleared above are published again right away, whatever the sync mode
+        self.publish_all()
+
+    async def reset_async(self):
+        for device in self.devices.values():
+            device.reset_published()
+            device.invalidate_cache()
+        await self.setup_async()
+        await self.register_all_async()
+        self.publish_all()
+
+    def loop_start(self):
+        if self.is_asyncio():
+            import asyncio
+
+            asyncio.run(self.loop_async())
+            return
+        self.warm_start()
+        self.hikumo.start_session()
+        self.setup()
+        self.register_all()
+        self.start_replay()
+        due_time = time.time()
+        while self.is_running():
+            self.wakeup.wait(self.with_retry_delay(max(0, due_time - time.time())))
+            self.wakeup.clear()
+            if time.time() < due_time:
+                self.run_pending()
+                continue
+            due_time = time.time() + self.step()
+        self.replayer.log_stats()
+
+    # One single refresh, for cron-like schedules: publishes the discovery and state messages from one setup fetch and
+    # returns once they are sent. Command topics are not subscribed to, since the commands could not be applied.
+    def run_once(self):
+        self.hikumo.start_session()
+        self.update_all_devices()
+        self.configure_devices()
+        self.start_mqtt()
+        self.publish_discovery_all()
+        self.publish_all()
+        self.stop_mqtt()
+        return self.is_setup_applied()
+
+    # Whether a setup was received from Hi-Kumo since the start
+    def is_setup_applied(self):
+        if self.last_setup_check == 0:
+            logging.error("Could not get the setup of the Hi-Kumo account")
+            return False
+        return True
+
+    def stop_mqtt(self):
+        if not self.owns_mqtt_client:
+            return
+        disconnect_mqtt(self.mqtt_client)
+        self.mqtt_loop_started = False
+
+    # API calls, refresh, command dispatch and MQTT I/O all run on one single asyncio event loop
+    async def loop_async(self):
+        import asyncio
+
+        self.start_async()
+        MqttAsyncioHelper(asyncio.get_running_loop(), self.mqtt_client)
+        connect_mqtt(self.config, self.mqtt_client)
+        try:
+            await self.warm_start_async()
+            await self.hikumo.start_session()
+            await self.setup_async()
+            await self.register_all_async()
+            self.start_replay()
+            while self.is_running():
+                await asyncio.sleep(await self.step_async())
+            self.replayer.log_stats()
+        finally:
+            await self.hikumo.close()
+
+    # The bridge runs until the end of the replay, if any
+    def is_running(self):
+        return self.replayer is None or not self.replayer.is_finished()
+
+    def start_replay(self):
+        if self.replayer is None:
+            return
+        mqtt_client = self.mqtt_client
+        if self.is_asyncio():
+            import asyncio
+
+            loop = asyncio.get_running_loop()
+
+            def deliver(message):
+                loop.call_soon_threadsafe(mqtt_client.on_message, mqtt_client, None, message)
+        else:
+            def deliver(message):
+                mqtt_client.on_message(mqtt_client, None, message)
+        threading.Thread(target=self.replayer.deliver_messages, args=(deliver,), name="aasivak-replay",
+                         daemon=True).start()
+
+    def record_message(self, message):
+        if self.recorder is not None:
+            self.recorder.message(message)
+
+    def on_message(self, client, userdata, message):
+        metrics.inc("aasivak_mqtt_messages_received_total")
+        self.record_message(message)
+        if message.topic == self.config.mqtt_reset_topic:
+            self.request_reset()
+            return
+        if message.topic == self.config.mqtt_profile_topic:
+            profiler.start(self.config, message.payload)
+            return
+
+        route = self.routes.get(message.topic, None)
+        if route is None:
+            logging.debug("Ignoring MQTT message on unknown topic '%s'", message.topic)
+            return
+        self.dispatch(route, message.payload)
+
+    def dispatch(self, route, payload):
+        device, attr, parser = route
+        value = payload
+        try:
+            value = str(payload.decode("utf-8"))
+            logging.info("MQTT message received device '" + device.id + "' command '" + attr + "' value '"
+                         + value + "'")
+            # float("inf") is parsed, but cannot be converted to an int
+            value = parser(value)
+        except (ValueError, OverflowError):
+            logging.warning("Invalid value '%s' for command '%s' of device '%s'", value, attr, device.id)
+            return
+        self.journal.record(device, attr, value)
+        device.on_command(attr, value)
+        if self.config.optimistic_state:
+            # Home Assistant shows the commanded state right away, it is rolled back if Hi-Kumo does not apply it
+            device.publish_state()
+        self.delayer.reset()
+
+
+################
+
+# Several Hi-Kumo accounts bridged by one single process. Each account is a House with its own prefixes, and they all
+# share one MQTT connection, one HTTP connection pool, one command scheduler and one refresh scheduler.
+class HouseGroup:
+    def __init__(self, raw_config):
+        # The shared settings only: the credentials can be set for each account alone
+        self.config = Config(raw_config)
+        account_configs = [self.account_config(raw_config, account) for account in raw_config["accounts"]]
+        for account_config in account_configs:
+            account_config.check_account()
+        logging.basicConfig(level=self.config.logging_level, format="%(asctime)-15s %(levelname)-8s %(message)s")
+        self.mqtt_client = create_mqtt_client(self.config)
+        start_metrics_server(self.config)
+        if self.config.event_loop != "asyncio":
+            connect_mqtt(self.config, self.mqtt_client)
+            self.scheduler = CommandScheduler(self.config)
+        else:
+            self.scheduler = None
+        self.http_adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.config.http_pool_connections,
+            pool_maxsize=max(self.config.http_pool_maxsize, len(raw_config["accounts"])))
+        self.routes = {}
+        self.wakeup = threading.Event()
+        self.houses = [House(account_config, self.mqtt_client, self.http_adapter, self.scheduler, self.routes)
+                       for account_config in account_configs]
+
+    @staticmethod
+    def account_config(raw_config, raw_account):
+        raw = dict(raw_config)
+        raw.update(raw_account)
+        # Unless set explicitly, each account gets its own state and command prefixes
+        for key in ("mqtt_state_prefix", "mqtt_command_prefix"):
+            if key not in raw_account:
+                raw[key] = raw.get(key, getattr(Config, key)) + "/" + raw_account["name"]
+        for key in ("snapshot_file", "record_file", "replay_file", "command_journal_file", "session_file"):
+            if raw.get(key, None) and key not in raw_account:
+                root, extension = os.path.splitext(raw[key])
+                raw[key] = root + "." + raw_account["name"] + extension
+        return Config(raw)
+
+    def on_message(self, client, userdata, message):
+        metrics.inc("aasivak_mqtt_messages_received_total")
+        route = self.routes.get(message.topic, None)
+        if route is not None:
+            route[0].house.record_message(message)
+            route[0].house.dispatch(route, message.payload)
+            return
+        if message.topic == self.config.mqtt_profile_topic:
+            profiler.start(self.config, message.payload)
+            return
+        for house in self.houses:
+            if message.topic == house.config.mqtt_reset_topic:
+                house.record_message(message)
+                house.request_reset()
+
+    def on_connect(self, client, userdata, flags, rc):
+        for house in self.houses:
+            house.on_connect(client, userdata, flags, rc)
+
+    def is_running(self):
+        return all(house.is_running() for house in self.houses)
+
+    def log_replay_stats(self):
+        for house in self.houses:
+            house.replayer.log_stats()
+
+    def first_due_times(self):
+        # Spread the first refreshes of the accounts over the shortest refresh delay
+        now = time.time()
+        spread = min(self.config.refresh_delays) / len(self.houses)
+        return [(now + index * spread, index) for index in range(len(self.houses))]
+
+    def run_once(self):
+        self.mqtt_client.loop_start()
+        for house in self.houses:
+            house.hikumo.start_session()
+            house.update_all_devices()
+            house.configure_devices()
+            house.publish_discovery_all()
+            house.publish_all()
+        disconnect_mqtt(self.mqtt_client)
+        return all([house.is_setup_applied() for house in self.houses])
+
+    def loop_start(self):
+        if self.config.event_loop == "asyncio":
+            import asyncio
+
+            asyncio.run(self.loop_async())
+            return
+        self.mqtt_client.on_message = self.on_message
+        self.mqtt_client.on_connect = self.on_connect
+        if not self.config.replay_file:
+            self.mqtt_client.loop_start()
+        for house in self.houses:
+            house.wakeup = self.wakeup
+            house.warm_start()
+        for house in self.houses:
+            house.hikumo.start_session()
+            house.setup()
+            house.register_all()
+            house.start_replay()
+        due_times = self.first_due_times()
+        heapq.heapify(due_times)
+        while self.is_running():
+            due_time, index = heapq.heappop(due_times)
+            delay = max(0, due_time - time.time())
+            for house in self.houses:
+                delay = house.with_retry_delay(delay)
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+            if time.time() < due_time:
+                for house in self.houses:
+                    house.run_pending()
+                heapq.heappush(due_times, (due_time, index))
+                continue
+            delay = self.houses[index].step()
+            heapq.heappush(due_times, (time.time() + delay, index))
+        self.log_replay_stats()
+
+    async def loop_async(self):
+        import asyncio
+
+        self.scheduler = AsyncCommandScheduler(self.config)
+        connector = async_connector(self.config)
+        for house in self.houses:
+            house.scheduler = self.scheduler
+            house.start_async(connector)
+        MqttAsyncioHelper(asyncio.get_running_loop(), self.mqtt_client)
+        connect_mqtt(self.config, self.mqtt_client)
+        try:
+            self.mqtt_client.on_message = self.on_message
+            self.mqtt_client.on_connect = self.on_connect
+            for house in self.houses:
+                await house.warm_start_async()
+            for house in self.houses:
+                await house.hikumo.start_session()
+                await house.setup_async()
+                await house.register_all_async()
+                house.start_replay()
+            due_times = self.first_due_times()
+            heapq.heapify(due_times)
+            while self.is_running():
+                due_time, index = heapq.heappop(due_times)
+                await asyncio.sleep(max(0, due_time - time.time()))
+                delay = await self.houses[index].step_async()
+                heapq.heappush(due_times, (time.time() + delay, index))
+            self.log_replay_stats()
+        finally:
+            for house in self.houses:
+                await house.hikumo.close()
+            await connector.close()
+
+
+def create_mqtt_client(config):
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        # paho-mqtt 2 must be told that the callbacks have the paho-mqtt 1 signatures
+        mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, config.mqtt_client_name)
+    else:
+        mqtt_client = mqtt.Client(config.mqtt_client_name)
+    if config.mqtt_username is not None:
+        mqtt_client.username_pw_set(config.mqtt_username, config.mqtt_password)
+    return mqtt_client
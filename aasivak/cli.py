@@ -0,0 +1,40 @@
+import argparse
+
+import aasivak
+
+
+################
+
+# aasivak [--config FILE]... [--once]
+#
+# Without --config, the configuration is read from config/default.yml and config/local.yml in the current directory.
+# With --once, Aasivak fetches the Hi-Kumo setup, publishes it to MQTT and exits, for cron-like schedules.
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog="aasivak", description="Hi-Kumo bridge for Home Assistant")
+    parser.add_argument("-c", "--config", action="append", metavar="FILE",
+                        help="configuration file, can be repeated: the keys of each file override the ones before it")
+    parser.add_argument("--once", action="store_true",
+                        help="publish the state of the devices once and exit, instead of bridging continuously")
+    parser.add_argument("--version", action="version", version="%(prog)s " + aasivak.__version__)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    # Only imported once the arguments are valid, so that --help and --version stay fast
+    from aasivak.bridge import Config, House, HouseGroup
+
+    raw_config = House.read_raw_config(args.config)
+    if args.once:
+        # A single fetch gains nothing from the event loop
+        raw_config["event_loop"] = "threads"
+    if raw_config.get("accounts", None):
+        bridge = HouseGroup(raw_config)
+    else:
+        bridge = House(Config(raw_config))
+    if args.once:
+        # Non-zero when nothing could be published, so that cron reports it
+        return 0 if bridge.run_once() else 1
+    bridge.loop_start()
+    return 0
@@ -0,0 +1,78 @@
+import threading
+
+
+################
+
+# In-process stand-in for the MQTT broker and the paho client: records what the bridge publishes and subscribes to,
+# and delivers injected messages to the bridge's on_message callback like paho's network thread would.
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+        self.retain = False
+
+
+class FakeMqttClient:
+    def __init__(self):
+        self.on_message = None
+        self.subscriptions = set()
+        self.retained = {}
+        self.published = 0
+        self.published_bytes = 0
+        self.subscribe_calls = 0
+        self.lock = threading.Lock()
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60):
+        return 0
+
+    def loop_start(self):
+        return 0
+
+    def loop_stop(self):
+        return 0
+
+    def subscribe(self, topic, qos=0):
+        # Like paho, accepts either one topic or a list of (topic, qos) tuples
+        topics = [topic] if isinstance(topic, str) else [name for name, topic_qos in topic]
+        with self.lock:
+            self.subscriptions.update(topics)
+            self.subscribe_calls += 1
+        return 0, self.subscribe_calls
+
+    def unsubscribe(self, topic, properties=None):
+        topics = [topic] if isinstance(topic, str) else topic
+        with self.lock:
+            self.subscriptions.difference_update(topics)
+        return 0, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        payload = b"" if payload is None else str(payload).encode("utf-8")
+        with self.lock:
+            self.published += 1
+            self.published_bytes += len(topic) + len(payload)
+            if retain:
+                self.retained[topic] = payload
+
+    def is_subscribed(self, topic):
+        with self.lock:
+            return any(topic_matches(subscription, topic) for subscription in self.subscriptions)
+
+    def inject(self, topic, payload):
+        if self.on_message is not None and self.is_subscribed(topic):
+            self.on_message(self, None, FakeMessage(topic, payload.encode("utf-8")))
+
+
+def topic_matches(subscription, topic):
+    subscription_levels = subscription.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(subscription_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels) or (level != "+" and level != topic_levels[index]):
+            return False
+    return len(subscription_levels) == len(topic_levels)
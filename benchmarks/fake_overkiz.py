@@ -0,0 +1,211 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+
+################
+
+# Stand-in for the Hi-Kumo/Overkiz cloud API: serves /login, /setup, /setup/gateways, the per-device states,
+# exec/apply, exec/current and the event listener endpoints, with a configurable latency, error rate and number of
+# devices.
+# /setup has an ETag and answers a matching If-None-Match with a 304. With changes, the room temperature of this share
+# of the climate devices changes before each /setup answer, so that the setup is not always unchanged.
+# With a token, it stands in for the local API of the gateway instead and requires it as a bearer token.
+
+GATEWAY_ID = "1234-5678-9012"
+
+
+def device_url(index):
+    return "io://" + GATEWAY_ID + "/" + str(10000 + index)
+
+
+def climate_device(index):
+    return {
+        "oid": "bench-%05d" % index,
+        "label": "Unit %d" % index,
+        "deviceURL": device_url(index),
+        "type": 1,
+        "definition": {
+            "commands": [{"commandName": "globalControl", "nparams": 6}],
+            "states": [
+                {"qualifiedName": "hlrrwifi:MainOperationState", "values": ["on", "off"]},
+                {"qualifiedName": "hlrrwifi:ModeChangeState",
+                 "values": ["auto", "autoCooling", "cooling", "dehumidify", "fan", "heating"]},
+                {"qualifiedName": "hlrrwifi:FanSpeedState", "values": ["auto", "hi", "lo", "med", "silent"]},
+                {"qualifiedName": "hlrrwifi:SwingState", "values": ["both", "horizontal", "stop", "vertical"]},
+                {"qualifiedName": "core:NameState", "values": []}
+            ]
+        },
+        "states": [
+            {"name": "hlrrwifi:MainOperationState", "type": 3, "value": "on"},
+            {"name": "hlrrwifi:LeaveHomeState", "type": 3, "value": "off"},
+            {"name": "hlrrwifi:ModeChangeState", "type": 3, "value": "heating"},
+            {"name": "hlrrwifi:SwingState", "type": 3, "value": "both"},
+            {"name": "hlrrwifi:FanSpeedState", "type": 3, "value": "silent"},
+            {"name": "hlrrwifi:RoomTemperatureState", "type": 1, "value": 20 + index % 5},
+            {"name": "core:TargetTemperatureState", "type": 1, "value": 21},
+            {"name": "hlrrwifi:OutdoorTemperatureState", "type": 1, "value": 252},
+            {"name": "core:ProductModelNameState", "type": 3, "value": "RAK-25PSB"},
+            {"name": "core:StatusState", "type": 3, "value": "available"}
+        ],
+        "attributes": [{"name": "core:FirmwareRevision", "type": 3, "value": "1.0.0"}]
+    }
+
+
+def other_device(index):
+    return {
+        "oid": "other-%05d" % index,
+        "label": "Sensor %d" % index,
+        "deviceURL": "io://" + GATEWAY_ID + "/" + str(90000 + index),
+        "type": 2,
+        "definition": {"commands": [], "states": [{"qualifiedName": "core:LuminanceState", "values": []}]},
+        "states": [{"name": "core:LuminanceState", "type": 2, "value": 100.0}],
+        "attributes": []
+    }
+
+
+class FakeOverkiz:
+    def __init__(self, devices, other_devices=0, latency=0.0, error_rate=0.0, token=None, changes=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.token = token
+        self.changes = changes
+        self.climate_devices = devices
+        self.gateways = [{"gatewayId": GATEWAY_ID, "alive": True, "connectivity": {"status": "OK"}}]
+        self.devices = [climate_device(index) for index in range(devices)]
+        self.devices += [other_device(index) for index in range(other_devices)]
+        self.states = {device["deviceURL"]: device["states"] for device in self.devices}
+        self.requests = {}
+        self.executions = 0
+        self.events = []
+        self.lock = threading.Lock()
+        self.update_setup_body()
+
+    def update_setup_body(self):
+        self.setup_body = json.dumps({"gateways": self.gateways, "devices": self.devices}).encode("utf-8")
+        self.setup_etag = '"setup-%08x"' % (hash(self.setup_body) & 0xffffffff)
+
+    def change_states(self):
+        with self.lock:
+            changed = max(1, int(self.climate_devices * self.changes))
+            for device in random.sample(self.devices[:self.climate_devices], min(changed, self.climate_devices)):
+                state = next(state for state in device["states"] if state["name"] == "hlrrwifi:RoomTemperatureState")
+                state["value"] = 20 + (state["value"] - 19) % 5
+            self.update_setup_body()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def handle(self, method, path, body, authorization=None, if_none_match=None):
+        if self.token is not None and authorization != "Bearer " + self.token:
+            return 401, b'{"error": "Missing authorization token."}'
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, b'{"error": "Service unavailable"}'
+
+        if path.endswith("/login"):
+            self.count("/login")
+            return 200, b'{"success": true, "roles": []}'
+        if path.endswith("/setup"):
+            self.count("/setup")
+            if self.changes:
+                self.change_states()
+            if if_none_match is not None and if_none_match == self.setup_etag:
+                return 304, b""
+            return 200, self.setup_body
+        if path.endswith("/setup/gateways"):
+            self.count("/setup/gateways")
+            return 200, json.dumps(self.gateways).encode("utf-8")
+        if "/setup/devices/" in path and path.endswith("/states"):
+            self.count("/setup/devices/states")
+            url = unquote(path[path.index("/setup/devices/") + len("/setup/devices/"):-len("/states")])
+            if url not in self.states:
+                return 404, b'{"error": "Unknown object"}'
+            return 200, json.dumps(self.states[url]).encode("utf-8")
+        if path.endswith("/exec/apply") and method == "POST":
+            self.count("/exec/apply")
+            with self.lock:
+                self.executions += 1
+                exec_id = "exec-%d" % self.executions
+                # Executions complete right away
+                self.events.append({"name": "ExecutionStateChangedEvent", "execId": exec_id, "newState": "COMPLETED"})
+            return 200, json.dumps({"execId": exec_id}).encode("utf-8")
+        if "/exec/current/" in path:
+            self.count("/exec/current")
+            return 200, b'{}'
+        if path.endswith("/events/register") and method == "POST":
+            self.count("/events/register")
+            return 200, b'{"id": "bench-listener"}'
+        if "/events/" in path and path.endswith("/fetch"):
+            self.count("/events/fetch")
+            with self.lock:
+                events, self.events = self.events, []
+            return 200, json.dumps(events).encode("utf-8")
+        return 404, b'{"error": "Not found"}'
+
+    def serve(self, port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # The headers and the body are written separately: with Nagle, a small body waits for the delayed ACK
+            disable_nagle_algorithm = True
+
+            def respond(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, payload = fake.handle(method, self.path, body, self.headers.get("Authorization"),
+                                              self.headers.get("If-None-Match"))
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                if self.path.endswith("/setup") and fake.setup_etag is not None:
+                    self.send_header("ETag", fake.setup_etag)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.respond("GET")
+
+            def do_POST(self):
+                self.respond("POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        server.daemon_threads = True
+        return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Hi-Kumo/Overkiz API server")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--other-devices", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="average response latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 503")
+    parser.add_argument("--token", help="serve the local API of the gateway, with this bearer token")
+    parser.add_argument("--changes", type=float, default=0.0,
+                        help="share of the climate devices whose state changes before each /setup answer")
+    args = parser.parse_args()
+
+    server = FakeOverkiz(args.devices, args.other_devices, args.latency, args.error_rate, args.token,
+                         args.changes).serve(args.port)
+    # The benchmark runner reads the actual port on the first line
+    print(server.server_port, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+LOCAL_TOKEN = "bench-token"
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+
+################
+
+# Runs the bridge against the fake Overkiz server and the in-process MQTT stand-in, without any network access.
+# Each installation size runs in its own process so that the thread count and memory figures are not mixed up.
+#
+#   python benchmarks/run.py --devices 1 50 500
+
+def start_fake_overkiz(args, devices, latency, token=None):
+    command = [sys.executable, os.path.join(BENCHMARKS_DIR, "fake_overkiz.py"),
+               "--devices", str(devices), "--other-devices", str(args.other_devices),
+               "--latency", str(latency), "--error-rate", str(args.error_rate), "--changes", str(args.changes)]
+    if token is not None:
+        command += ["--token", token]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    port = int(server.stdout.readline())
+    return server, "http://127.0.0.1:%d/enduser-mobile-web/enduserAPI" % port
+
+
+def percentile(values, ratio):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(ratio * (len(values) - 1))))]
+
+
+def command_latencies(commands, completions):
+    latencies = []
+    for url, injected in commands:
+        completed = [moment for moment in completions.get(url, []) if moment >= injected]
+        if completed:
+            latencies.append(min(completed) - injected)
+    return latencies
+
+
+def build_house(args, api_url, local_api_url, mqtt_client):
+    import aasivak
+    from fake_overkiz import GATEWAY_ID
+
+    raw_config = {
+        "api_username": "bench",
+        "api_password": "bench",
+        "api_url": api_url,
+        "action_delay": args.action_delay,
+        "sync_mode": args.sync_mode,
+        "state_refresh": args.state_refresh,
+        "api_retry_delay": 0.01
+    }
+    if local_api_url is not None:
+        raw_config["local_gateways"] = {GATEWAY_ID: {"url": local_api_url, "token": LOCAL_TOKEN}}
+    return aasivak.House(aasivak.Config(raw_config), mqtt_client)
+
+
+def run_single(args, devices):
+    from fake_mqtt import FakeMqttClient
+
+    server, api_url = start_fake_overkiz(args, devices, args.latency)
+    local_server, local_api_url = None, None
+    if args.local:
+        local_server, local_api_url = start_fake_overkiz(args, devices, args.local_latency, LOCAL_TOKEN)
+    try:
+        mqtt_client = FakeMqttClient()
+        started = time.time()
+        house = build_house(args, api_url, local_api_url, mqtt_client)
+        house.hikumo.login()
+        house.setup()
+        house.register_all()
+        mqtt_client.on_message = house.on_message
+        startup = time.time() - started
+
+        # Refresh throughput
+        started = time.time()
+        for cycle in range(args.cycles):
+            house.step()
+        refresh_duration = time.time() - started
+
+        # Command to exec/apply completion latency
+        completions = {}
+        apply_actions = house.hikumo.apply_actions
+
+        def timed_apply_actions(actions, transport=None):
+            response = apply_actions(actions, transport)
+            completed = time.time()
+            for action in actions:
+                completions.setdefault(action["deviceURL"], []).append(completed)
+            return response
+
+        house.hikumo.apply_actions = timed_apply_actions
+        device_list = list(house.devices.values())
+        commands = []
+        peak_threads = threading.active_count()
+        for index in range(args.commands):
+            device = random.choice(device_list)
+            topic, (attr, parser) = next((topic, route) for topic, route in device.command_topics.items()
+                                         if route[0] == "target_temperature")
+            commands.append((device.command_url, time.time()))
+            mqtt_client.inject(topic, str(18 + index % 10))
+            peak_threads = max(peak_threads, threading.active_count())
+            time.sleep(args.command_interval)
+        deadline = time.time() + args.action_delay + 10
+        while time.time() < deadline and len(command_latencies(commands, completions)) < len(commands):
+            time.sleep(0.01)
+        latencies = command_latencies(commands, completions)
+
+        # MQTT messages sent when Home Assistant restarts and asks for a reset
+        published = mqtt_client.published
+        mqtt_client.inject(house.config.mqtt_reset_topic, "")
+        house.step()
+        reset_messages = mqtt_client.published - published
+
+        return {
+            "devices": devices,
+            "startup_s": startup,
+            "refresh_cycles_per_s": args.cycles / refresh_duration,
+            "refresh_ms_per_cycle": 1000 * refresh_duration / args.cycles,
+            "commands": len(commands),
+            "applied_commands": len(latencies),
+            "apply_calls": sum(len(times) for times in completions.values()),
+            "command_p50_ms": 1000 * percentile(latencies, 0.5),
+            "command_p90_ms": 1000 * percentile(latencies, 0.9),
+            "command_p99_ms": 1000 * percentile(latencies, 0.99),
+            "peak_threads": peak_threads,
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "mqtt_published": mqtt_client.published,
+            "mqtt_subscribe_calls": mqtt_client.subscribe_calls,
+            "reset_messages": reset_messages,
+            "mqtt_published_bytes": mqtt_client.published_bytes
+        }
+    finally:
+        for fake_server in (server, local_server):
+            if fake_server is not None:
+                fake_server.terminate()
+                fake_server.wait()
+
+
+def print_report(results):
+    columns = [
+        ("devices", "%d"), ("startup_s", "%.2f"), ("refresh_cycles_per_s", "%.1f"), ("refresh_ms_per_cycle", "%.1f"),
+        ("applied_commands", "%d"), ("apply_calls", "%d"), ("command_p50_ms", "%.0f"), ("command_p90_ms", "%.0f"),
+        ("command_p99_ms", "%.0f"), ("peak_threads", "%d"), ("max_rss_mb", "%.1f"), ("mqtt_published", "%d"),
+        ("mqtt_subscribe_calls", "%d"), ("reset_messages", "%d")
+    ]
+    widths = [max(len(name), 8) for name, fmt in columns]
+    print("  ".join(name.rjust(width) for (name, fmt), width in zip(columns, widths)))
+    for result in results:
+        print("  ".join((fmt % result[name]).rjust(width) for (name, fmt), width in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aasivak benchmark")
+    parser.add_argument("--devices", type=int, nargs="+", default=[1, 50, 500])
+    parser.add_argument("--other-devices", type=int, default=0, help="non climate devices in the Hi-Kumo setup")
+    parser.add_argument("--cycles", type=int, default=20, help="number of refresh cycles")
+    parser.add_argument("--commands", type=int, default=100, help="number of MQTT commands")
+    parser.add_argument("--command-interval", type=float, default=0.01, help="seconds between two MQTT commands")
+    parser.add_argument("--action-delay", type=float, default=0.5)
+    parser.add_argument("--latency", type=float, default=0.0, help="fake API average latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of fake API calls failing with a 503")
+    parser.add_argument("--changes", type=float, default=0.1,
+                        help="share of the devices whose state changes between two setup fetches, 0 for none")
+    parser.add_argument("--local", action="store_true", help="send commands and device refreshes to a fake local API")
+    parser.add_argument("--local-latency", type=float, default=0.0, help="fake local API average latency in seconds")
+    parser.add_argument("--sync-mode", default="poll", choices=["poll", "events"])
+    parser.add_argument("--state-refresh", default="setup", choices=["setup", "devices"])
+    parser.add_argument("--json", action="store_true", help="print the results as json lines")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(run_single(args, args.single)))
+        return
+
+    results = []
+    for devices in args.devices:
+        command = [sys.executable, os.path.abspath(__file__), "--single", str(devices)] + [
+            argument for argument in sys.argv[1:] if argument != "--json"]
+        command = strip_devices_argument(command)
+        output = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        print_report(results)
+
+
+# The --devices list only matters to the parent process
+def strip_devices_argument(command):
+    stripped = []
+    skipping = False
+    for argument in command:
+        if argument == "--devices":
+            skipping = True
+            continue
+        if skipping and not argument.startswith("--"):
+            continue
+        skipping = False
+        stripped.append(argument)
+    return stripped
+
+
+if __name__ == "__main__":
+    main()
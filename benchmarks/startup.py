@@ -0,0 +1,81 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+################
+
+# Measures the cold start of Aasivak in fresh processes, as a supervisor or a cron job would start it, and checks it
+# against the startup budget. The times are the median of several runs, minus the startup of a bare interpreter.
+#
+#   python benchmarks/startup.py
+
+# Name, python arguments, budget in milliseconds
+STEPS = [
+    ("import aasivak", ["-c", "import aasivak"], 20),
+    ("aasivak --version", ["-m", "aasivak", "--version"], 50),
+    ("import aasivak.bridge", ["-c", "import aasivak.bridge"], 150),
+    ("once, 50 devices", [os.path.join(BENCHMARKS_DIR, "startup.py"), "--once-child"], 500)
+]
+
+
+def run_once_child():
+    # Started in a fresh process by the parent: one --once run against the fake Overkiz server and MQTT client
+    sys.path.insert(0, ROOT_DIR)
+    sys.path.insert(0, BENCHMARKS_DIR)
+    import aasivak
+    from fake_mqtt import FakeMqttClient
+
+    house = aasivak.House(aasivak.Config({"api_username": "bench", "api_password": "bench",
+                                          "api_url": os.environ["AASIVAK_BENCH_API_URL"]}), FakeMqttClient())
+    house.run_once()
+    if len(house.devices) != 50:
+        sys.exit("Unexpected number of devices: %d" % len(house.devices))
+
+
+def time_process(arguments, runs):
+    durations = []
+    for run in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable] + arguments, cwd=ROOT_DIR, stdout=subprocess.DEVNULL, check=True)
+        durations.append(time.perf_counter() - started)
+    return 1000 * statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aasivak cold start benchmark")
+    parser.add_argument("--runs", type=int, default=10, help="runs of each step")
+    parser.add_argument("--once-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.once_child:
+        run_once_child()
+        return 0
+
+    server = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_DIR, "fake_overkiz.py"), "--devices", "50"],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(server.stdout.readline())
+        os.environ["AASIVAK_BENCH_API_URL"] = "http://127.0.0.1:%d/enduser-mobile-web/enduserAPI" % port
+        baseline = time_process(["-c", "pass"], args.runs)
+        print("%-24s %10s %10s" % ("step", "ms", "budget"))
+        print("%-24s %10.1f" % ("python", baseline))
+        over_budget = False
+        for name, arguments, budget in STEPS:
+            duration = time_process(arguments, args.runs) - baseline
+            over_budget = over_budget or duration > budget
+            print("%-24s %10.1f %10d%s" % (name, duration, budget, "  OVER BUDGET" if duration > budget else ""))
+    finally:
+        server.terminate()
+        server.wait()
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+# Lets the tests import the aasivak package and the benchmark stand-ins from a clone of the repository
@@ -1,14 +1,23 @@
 from setuptools import setup
 
+install_requires = ['paho-mqtt', 'PyYAML', 'requests[socks]>=2.10.0', 'PySocks']
+
 setup(
     name='Aasivak',
-    version='0.1.0',
-    packages=[''],
+    version='0.2.0',
+    packages=['aasivak'],
+    install_requires=install_requires,
+    extras_require={
+        'asyncio': ['aiohttp'],
+        'stream': ['ijson'],
+    },
+    entry_points={
+        'console_scripts': ['aasivak=aasivak.cli:main'],
+    },
+    python_requires='>=3.7',
     url='https://github.com/dotvav/aasivak',
     license='',
     author='dotvav',
     author_email='',
     description='Hikumo bridge for Home Assistant'
 )
-
-install_requires = ['paho-mqtt', 'PyYAML', 'requests[socks]', 'PySocks']
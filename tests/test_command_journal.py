@@ -0,0 +1,54 @@
+import time
+
+from aasivak.bridge import CommandJournal, Config
+
+
+class FakeDevice:
+    def __init__(self, device_id):
+        self.id = device_id
+        self.command_sent = 0
+
+
+def test_deferred_devices_are_retried_after_the_delay():
+    journal = CommandJournal(Config({"command_retry_delay": 10, "command_retry_max_delay": 300}))
+    device = FakeDevice("d1")
+    journal.record(device, "mode", "heat")
+    delay = journal.defer([device])
+    assert 0 <= delay <= 10
+    assert journal.retry_delay() is not None
+    journal.retry_at = time.time() - 1
+    assert journal.due_retries() == [device]
+    assert journal.due_retries() == []
+    assert journal.retry_delay() is None
+
+
+def test_acknowledge_keeps_the_commands_received_while_sending():
+    journal = CommandJournal(Config({}))
+    device = FakeDevice("d1")
+    journal.record(device, "mode", "heat")
+    device.command_sent = time.time()
+    journal.record(device, "fan_mode", "high")
+    journal.commands["d1"]["fan_mode"][1] = device.command_sent + 1
+    journal.acknowledge([device])
+    assert journal.pending_commands() == {"d1": {"fan_mode": "high"}}
+
+
+def test_old_commands_are_dropped():
+    journal = CommandJournal(Config({"command_max_age": 60}))
+    device = FakeDevice("d1")
+    journal.record(device, "mode", "heat")
+    journal.commands["d1"]["mode"][1] -= 61
+    assert not journal.has_commands(device)
+    assert journal.pending_commands() == {}
+
+
+def test_survives_a_restart(tmp_path):
+    config = Config({"command_journal_file": str(tmp_path / "commands.json")})
+    CommandJournal(config).record(FakeDevice("d1"), "target_temperature", 21)
+    assert CommandJournal(config).pending_commands() == {"d1": {"target_temperature": 21}}
+
+
+def test_ignores_a_malformed_file(tmp_path):
+    journal_file = tmp_path / "commands.json"
+    journal_file.write_text("{\"commands\": ")
+    assert CommandJournal(Config({"command_journal_file": str(journal_file)})).pending_commands() == {}
@@ -0,0 +1,23 @@
+from aasivak.bridge import RequestBudget
+
+
+def test_bursts_up_to_the_capacity():
+    budget = RequestBudget(per_minute=60)
+    assert sum(budget.acquire() for _ in range(20)) == 10
+    assert budget.wait_time() > 0
+
+
+def test_refills_over_time():
+    budget = RequestBudget(per_minute=60)
+    while budget.acquire():
+        pass
+    budget.last_refill -= 3
+    assert budget.wait_time() == 0
+    assert sum(budget.acquire() for _ in range(10)) == 3
+
+
+def test_never_refills_above_the_capacity():
+    budget = RequestBudget(per_minute=60)
+    budget.last_refill -= 3600
+    budget.refill()
+    assert budget.tokens == budget.capacity
@@ -0,0 +1,49 @@
+import os
+import stat
+import time
+
+from aasivak.bridge import Config, SessionStore
+
+COOKIES = [["JSESSIONID", "abc", "example.com", "/", None]]
+
+
+def session_config(tmp_path, **raw):
+    return Config(dict({"api_username": "user", "session_file": str(tmp_path / "session.json")}, **raw))
+
+
+def test_reuses_a_saved_session(tmp_path):
+    config = session_config(tmp_path)
+    SessionStore(config).save(COOKIES)
+    assert stat.S_IMODE(os.stat(config.session_file).st_mode) == 0o600
+    store = SessionStore(config)
+    assert store.load() == COOKIES
+    assert not store.is_expired()
+
+
+def test_ignores_the_session_of_another_account(tmp_path):
+    SessionStore(session_config(tmp_path)).save(COOKIES)
+    assert SessionStore(session_config(tmp_path, api_username="other")).load() is None
+
+
+def test_ignores_an_expiring_session(tmp_path):
+    config = session_config(tmp_path, session_lifetime=100)
+    SessionStore(config).save([["JSESSIONID", "abc", "example.com", "/", time.time() + 5]])
+    assert SessionStore(config).load() is None
+
+
+def test_ignores_a_malformed_file(tmp_path):
+    config = session_config(tmp_path)
+    with open(config.session_file, "w") as session_file:
+        session_file.write("{\"cookies\": [")
+    store = SessionStore(config)
+    assert store.load() is None
+    assert store.expires is None
+
+
+def test_renews_in_the_last_tenth_of_the_lifetime(tmp_path):
+    store = SessionStore(session_config(tmp_path, session_lifetime=100))
+    store.expires = time.time() + 50
+    assert not store.is_expiring()
+    store.expires = time.time() + 5
+    assert store.is_expiring()
+    assert not store.is_expired()
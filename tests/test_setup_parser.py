@@ -0,0 +1,37 @@
+import io
+import json
+
+import pytest
+
+from aasivak.bridge import Device, parse_setup_stream
+from benchmarks.fake_overkiz import FakeOverkiz
+
+pytest.importorskip("ijson")
+
+
+# What the bridge reads from a setup parsed as a whole
+def filtered_setup(raw_setup):
+    devices = []
+    for raw_device in raw_setup["devices"]:
+        if raw_device["type"] != 1:
+            continue
+        devices.append({
+            "oid": raw_device["oid"],
+            "label": raw_device["label"],
+            "deviceURL": raw_device["deviceURL"],
+            "type": raw_device["type"],
+            "states": [state for state in raw_device["states"] if state["name"] in Device.raw_state_attributes],
+            "definition": {"states": [state for state in raw_device["definition"]["states"]
+                                      if state["qualifiedName"] in Device.raw_definition_attributes]}
+        })
+    return {"gateways": raw_setup["gateways"], "devices": devices}
+
+
+def test_stream_parser_matches_json():
+    server = FakeOverkiz(devices=20, other_devices=30)
+    assert parse_setup_stream(io.BytesIO(server.setup_body)) == filtered_setup(json.loads(server.setup_body))
+
+
+def test_stream_parser_skips_other_devices():
+    server = FakeOverkiz(devices=0, other_devices=5)
+    assert parse_setup_stream(io.BytesIO(server.setup_body))["devices"] == []
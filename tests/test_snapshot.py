@@ -0,0 +1,37 @@
+from aasivak.bridge import Config, House
+from benchmarks.fake_mqtt import FakeMqttClient
+
+RAW_DEVICE = {"id": "d1", "name": "Living room", "url": "io://1234-5678-9012/10000", "mode": "heating",
+              "temperature": 21, "available": "online", "last_update": 1000}
+
+
+def snapshot_house(tmp_path):
+    config = Config({"api_username": "user", "api_password": "password",
+                     "snapshot_file": str(tmp_path / "snapshot.json")})
+    return House(config, mqtt_client=FakeMqttClient(), scheduler=object())
+
+
+def test_restores_the_devices_as_stale(tmp_path):
+    (tmp_path / "snapshot.json").write_text(
+        '{"time": 1000, "gateways": {}, "devices": [%s]}' % str(RAW_DEVICE).replace("'", '"'))
+    house = snapshot_house(tmp_path)
+    assert house.load_snapshot()
+    device = house.devices["d1"]
+    assert (device.mode, device.temperature) == ("heating", 21)
+    assert device.stale
+    device.update_states([], True)
+    assert not device.stale
+
+
+def test_malformed_snapshot_falls_back_to_a_cold_start(tmp_path):
+    (tmp_path / "snapshot.json").write_text('{"time": 1000, "gateways": {}, "devices": [{"id": "d1"}, ')
+    house = snapshot_house(tmp_path)
+    assert not house.load_snapshot()
+    assert house.devices == {}
+
+
+def test_incomplete_snapshot_falls_back_to_a_cold_start(tmp_path):
+    (tmp_path / "snapshot.json").write_text('{"time": 1000, "gateways": [], "devices": [{"id": "d1"}]}')
+    house = snapshot_house(tmp_path)
+    assert not house.load_snapshot()
+    assert house.devices == {}